@@ -1,22 +1,30 @@
+import time
+# 啟動時間從這裡開始算，包含下面所有 import
+_startup_started = time.perf_counter()
+
 import os
 import uuid
+import functools
 import requests
-from urllib.parse import quote
+from urllib.parse import quote, urlencode, parse_qs
 import socket
+import threading
 from flask import Flask, request, abort, send_from_directory
 import json
 import re
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("lost_and_found")
 
-from linebot import LineBotApi, WebhookHandler
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 
 from linebot.models import (
-    MessageEvent, TextMessage, ImageMessage, LocationMessage,
+    MessageEvent, TextMessage, ImageMessage, LocationMessage, PostbackEvent,
     BubbleContainer, CarouselContainer,
-    BoxComponent, TextComponent, ImageComponent, ButtonComponent, URIAction,
+    BoxComponent, TextComponent, ImageComponent, ButtonComponent, URIAction, PostbackAction,
+    QuickReply, QuickReplyButton, LocationAction,
 )
 
 from linebot.models import TextSendMessage
@@ -25,35 +33,97 @@ from linebot.models import TextSendMessage
 FlexSendMessage = None
 try:
     from linebot.models import FlexSendMessage
-    logging.info("DEBUG: FlexSendMessage imported successfully from linebot.models.")
+    logger.debug("FlexSendMessage imported successfully from linebot.models.")
 except ImportError as e:
-    logging.warning(f"WARNING: Could not import FlexSendMessage: {e}. Flex Message functionality will be limited or replaced with text messages.")
+    logger.warning("Could not import FlexSendMessage: %s. Flex Message functionality will be limited or replaced with text messages.", e)
 
 try:
     from config import Config
-    logging.info("DEBUG: Config module imported successfully.")
+    from log_setup import configure_logging, LogSampler, Timer, StartupTimer
+    configure_logging(level=Config.LOG_LEVEL, fmt=Config.LOG_FORMAT)
+    logger.debug("Config module imported successfully.")
 except Exception as e:
-    logging.error(f"FATAL ERROR: Failed to import Config module: {e}", exc_info=True)
+    logger.error("FATAL ERROR: Failed to import Config module: %s", e, exc_info=True)
     exit(1)
 
 try:
-    from db_manager import DBManager, UserState
-    logging.info("DEBUG: DBManager module imported successfully.")
+    from db_manager import DBManager, UserState, SCHEMA_VERSION as DB_SCHEMA_VERSION
+    from state_cache import UserStateCache
+    from render_cache import RenderCache, PreserializedMessage
+    from event_queue import EventDispatcher, BatchDispatcher, BatchDispatchError, QueueFullError, sign_webhook_body
+    from event_dedup import EventDeduplicator
+    from janitor import Janitor
+    from line_http import CoalescingLineBotApi, PooledHttpClient, RetryBudget
+    from image_store import ImageStore
+    from metrics import Metrics
+    from command_router import CommandRouter
+    logger.debug("DBManager module imported successfully.")
 except Exception as e:
-    logging.error(f"FATAL ERROR: Failed to import DBManager module: {e}", exc_info=True)
+    logger.error("FATAL ERROR: Failed to import DBManager module: %s", e, exc_info=True)
     exit(1)
 
-logging.info(f"DEBUG: Read LINE_CHANNEL_ACCESS_TOKEN length: {len(Config.LINE_CHANNEL_ACCESS_TOKEN) if Config.LINE_CHANNEL_ACCESS_TOKEN else 0}")
-logging.info(f"DEBUG: Read LINE_CHANNEL_SECRET length: {len(Config.LINE_CHANNEL_SECRET) if Config.LINE_CHANNEL_SECRET else 0}")
+startup_timer = StartupTimer(start=_startup_started)
+startup_timer.mark("imports")
+
+metrics = Metrics(enabled=Config.METRICS_ENABLED)
+
+logger.debug("Read LINE_CHANNEL_ACCESS_TOKEN length: %d", len(Config.LINE_CHANNEL_ACCESS_TOKEN or ''))
+logger.debug("Read LINE_CHANNEL_SECRET length: %d", len(Config.LINE_CHANNEL_SECRET or ''))
+
+class LazyClient:
+    """第一次用到時才建立真正的 client；import 階段不做任何初始化，worker 可以更快開始接 request。"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
+
+def create_line_bot_api():
+    # 共用連線池與 keep-alive，暫時性錯誤在重試預算內以 jitter 退避重試
+    try:
+        return CoalescingLineBotApi(
+            Config.LINE_CHANNEL_ACCESS_TOKEN,
+            endpoint=Config.LINE_API_ENDPOINT,
+            data_endpoint=Config.LINE_API_DATA_ENDPOINT,
+            timeout=(Config.LINE_API_CONNECT_TIMEOUT, Config.LINE_API_READ_TIMEOUT),
+            http_client=functools.partial(
+                PooledHttpClient,
+                pool_size=Config.LINE_API_POOL_SIZE,
+                max_retries=Config.LINE_API_MAX_RETRIES,
+                backoff_base=Config.LINE_API_BACKOFF_BASE,
+                backoff_max=Config.LINE_API_BACKOFF_MAX,
+                retry_budget=RetryBudget(ratio=Config.LINE_API_RETRY_BUDGET_RATIO),
+                content_timeout=(Config.LINE_API_CONNECT_TIMEOUT, Config.LINE_API_CONTENT_TIMEOUT),
+                metrics=metrics,
+            ),
+        )
+    except Exception as e:
+        logger.critical("FATAL ERROR: Failed to initialize LINE Bot API. Exception: %s", e, exc_info=True)
+        raise
+
+line_bot_api = LazyClient(create_line_bot_api)
 
 try:
-    line_bot_api = LineBotApi(Config.LINE_CHANNEL_ACCESS_TOKEN)
     handler = WebhookHandler(Config.LINE_CHANNEL_SECRET)
-    logging.info("DEBUG: LINE Bot API and WebhookHandler initialized successfully.")
+    logger.debug("WebhookHandler initialized successfully.")
 except Exception as e:
-    logging.critical(f"FATAL ERROR: Failed to initialize LINE Bot API or WebhookHandler. Exception: {e}", exc_info=True)
-    line_bot_api = None
+    logger.critical("FATAL ERROR: Failed to initialize WebhookHandler. Exception: %s", e, exc_info=True)
     handler = None
+startup_timer.mark("line_clients")
 
 app = Flask(__name__)
 
@@ -62,185 +132,411 @@ try:
     if not app_port:
         app_port = os.getenv('PORT', '5000')
     app.config['PORT'] = int(app_port)
-    logging.info(f"DEBUG: Flask application configured to run on PORT: {app.config['PORT']}")
+    logger.debug("Flask application configured to run on PORT: %s", app.config['PORT'])
 except ValueError:
-    logging.error("FATAL ERROR: PORT environment variable is not a valid integer. Defaulting to 5000.")
+    logger.error("FATAL ERROR: PORT environment variable is not a valid integer. Defaulting to 5000.")
     app.config['PORT'] = 5000
 except Exception as e:
-    logging.error(f"FATAL ERROR: Could not determine application PORT: {e}", exc_info=True)
+    logger.error("FATAL ERROR: Could not determine application PORT: %s", e, exc_info=True)
     app.config['PORT'] = 5000
 
 current_port = os.getenv('PORT')
-logging.info(f"DEBUG: Application trying to run on PORT: {current_port}")
+logger.debug("Application trying to run on PORT: %s", current_port)
 
 app.config['UPLOAD_FOLDER'] = Config.UPLOAD_FOLDER
+# 前面有 Apache / lighttpd 之類支援 X-Sendfile 的伺服器時，直接交給它送檔案
+app.config['USE_X_SENDFILE'] = Config.UPLOAD_USE_X_SENDFILE
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
+startup_timer.mark("flask_app")
+
+state_cache = None
+if Config.STATE_CACHE_ENABLED:
+    state_cache = UserStateCache(
+        max_entries=Config.STATE_CACHE_MAX_ENTRIES,
+        ttl=Config.STATE_CACHE_TTL,
+        negative_ttl=Config.STATE_CACHE_NEGATIVE_TTL,
+    )
 
-db_manager = DBManager(Config.SQLITE_DB_PATH)
 try:
-    db_manager = DBManager(Config.SQLITE_DB_PATH)
-    logging.info("DEBUG: DBManager initialized successfully.")
+    db_manager = DBManager(
+        Config.SQLITE_DB_PATH,
+        busy_timeout_ms=Config.SQLITE_BUSY_TIMEOUT_MS,
+        cache_size_kb=Config.SQLITE_CACHE_SIZE_KB,
+        statement_cache_size=Config.SQLITE_STATEMENT_CACHE_SIZE,
+        state_cache=state_cache,
+        group_commit=Config.DB_GROUP_COMMIT,
+        group_commit_window_ms=Config.DB_GROUP_COMMIT_WINDOW_MS,
+        group_commit_max_batch=Config.DB_GROUP_COMMIT_MAX_BATCH,
+    )
+    metrics.instrument_db(db_manager)
+    logger.debug("DBManager initialized successfully.")
 except Exception as e:
-    logging.error(f"FATAL ERROR: Failed to initialize DBManager: {e}", exc_info=True)
+    logger.error("FATAL ERROR: Failed to initialize DBManager: %s", e, exc_info=True)
     exit(1)
+startup_timer.mark("database")
+
+# 以內容雜湊命名的檔案內容永遠不會變，可以讓 LINE 用戶端與 CDN 長期快取
+FINGERPRINTED_UPLOAD_PATTERN = re.compile(r'^([0-9a-f]{64})(_[a-z]+)?\.jpg$')
 
 @app.route('/static/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # conditional=True 會處理 If-None-Match / If-Modified-Since (304) 與 Range (206)，
+    # 檔案內容透過 wsgi.file_wrapper 交給 gunicorn 以 sendfile 傳送
+    match = FINGERPRINTED_UPLOAD_PATTERN.match(filename)
+    if match:
+        response = send_from_directory(
+            app.config['UPLOAD_FOLDER'], filename,
+            conditional=True,
+            etag=match.group(1) + (match.group(2) or ''),
+            max_age=Config.UPLOAD_CACHE_MAX_AGE,
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response = send_from_directory(
+            app.config['UPLOAD_FOLDER'], filename,
+            conditional=True,
+            max_age=Config.LEGACY_UPLOAD_CACHE_MAX_AGE,
+        )
+        response.cache_control.public = True
+    return response
+
+image_store = ImageStore(
+    app.config['UPLOAD_FOLDER'],
+    chunk_size=Config.IMAGE_CHUNK_SIZE,
+    carousel_size=Config.IMAGE_CAROUSEL_SIZE,
+)
+
+lost_items_render_cache = RenderCache(max_entries=Config.RENDER_CACHE_MAX_ENTRIES)
+
+# 背景 worker 處理事件時沒有 request context，圖片網址要用的 url_root 由這裡帶進去
+_event_context = threading.local()
+
+def public_url_root():
+    url_root = getattr(_event_context, 'url_root', None)
+    if url_root:
+        return url_root
+    return request.url_root
+
+def upload_url(filename):
+    # 設定 UPLOAD_BASE_URL 時圖片改由 CDN / 靜態伺服器提供，不佔用 webhook 的 worker
+    base_url = Config.UPLOAD_BASE_URL or (public_url_root().rstrip('/') + '/static/uploads')
+    url = base_url.rstrip('/') + '/' + filename
+    if not url.startswith('https://'):
+        url = url.replace('http://', 'https://')
+    return url
+
+def process_queued_webhook(job):
+    _event_context.url_root = job.url_root
+    metrics.workers_busy.inc()
+    if event_dispatcher is not None:
+        metrics.queue_depth.set(event_dispatcher.depth())
+    try:
+        with line_bot_api.collect_replies():
+            handler.handle(job.body, sign_webhook_body(Config.LINE_CHANNEL_SECRET, job.body))
+    finally:
+        metrics.workers_busy.dec()
+        _event_context.url_root = None
+
+event_dispatcher = None
+if Config.WEBHOOK_ASYNC:
+    event_dispatcher = EventDispatcher(
+        process_queued_webhook,
+        workers=Config.WEBHOOK_WORKERS,
+        max_queue=Config.WEBHOOK_QUEUE_MAX,
+        store=db_manager if Config.WEBHOOK_QUEUE_PERSIST else None,
+    )
+    logger.info("Webhook events will be processed by %d background workers.", Config.WEBHOOK_WORKERS)
+
+event_deduplicator = None
+if Config.WEBHOOK_DEDUP_ENABLED:
+    event_deduplicator = EventDeduplicator(
+        db_manager,
+        ttl=Config.WEBHOOK_DEDUP_TTL,
+        max_entries=Config.WEBHOOK_DEDUP_MAX_ENTRIES,
+    )
+
+batch_dispatcher = None
+if event_dispatcher is None and Config.WEBHOOK_BATCH_WORKERS > 0:
+    batch_dispatcher = BatchDispatcher(process_queued_webhook, max_workers=Config.WEBHOOK_BATCH_WORKERS)
+
+janitor = None
+if Config.JANITOR_INTERVAL > 0:
+    janitor = Janitor(
+        db_manager,
+        app.config['UPLOAD_FOLDER'],
+        item_ttl=Config.JANITOR_ITEM_TTL,
+        state_ttl=Config.JANITOR_STATE_TTL,
+        upload_grace=Config.JANITOR_UPLOAD_GRACE,
+        vacuum_pages=Config.JANITOR_VACUUM_PAGES,
+        interval=Config.JANITOR_INTERVAL,
+    )
+
+startup_timer.mark("components")
+
+@app.before_request
+def start_background_jobs():
+    # 與 EventDispatcher 相同，在 worker 行程收到第一個 request 時才啟動執行緒
+    if janitor is not None:
+        janitor.start()
+    # gauge 要在 worker 行程裡設定，fork 之前設的值不會算進 worker 的 metrics 檔案
+    if event_dispatcher is not None:
+        metrics.worker_threads.set(event_dispatcher.workers)
+    elif batch_dispatcher is not None:
+        metrics.worker_threads.set(batch_dispatcher.max_workers)
+
+@app.route('/healthz')
+def healthz():
+    # liveness：行程還活著就回 200，不檢查任何外部依賴
+    return {"status": "ok"}
+
+@app.route('/readyz')
+def readyz():
+    # readiness：資料庫可用、schema 已是最新版本、LINE 憑證與 handler 都設定好了才接流量
+    checks = {
+        "line_credentials": bool(Config.LINE_CHANNEL_ACCESS_TOKEN and Config.LINE_CHANNEL_SECRET),
+        "webhook_handler": handler is not None,
+    }
+    try:
+        checks["database"] = db_manager.schema_version() >= DB_SCHEMA_VERSION
+    except Exception as e:
+        logger.error("Readiness check failed to query the database: %s", e, exc_info=True)
+        checks["database"] = False
+    ready = all(checks.values())
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "checks": checks,
+        "line_client_initialized": line_bot_api.initialized,
+        "startup": startup_timer.as_dict(),
+    }
+    return body, 200 if ready else 503
+
+@app.route('/stats')
+def stats():
+    return {
+        "state_cache": state_cache.stats() if state_cache else None,
+        "render_cache": lost_items_render_cache.stats(),
+        "event_queue": event_dispatcher.stats() if event_dispatcher else None,
+        "batch_dispatch": batch_dispatcher.stats() if batch_dispatcher else None,
+        "dedup": event_deduplicator.stats() if event_deduplicator else None,
+        "janitor": janitor.stats() if janitor else None,
+        "line_api": line_bot_api.stats() if line_bot_api.initialized else None,
+        "group_commit": db_manager.group_committer.stats() if db_manager.group_committer else None,
+    }
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return "Metrics are disabled.\n", 404
+    body, content_type = metrics.render()
+    return body, 200, {"Content-Type": content_type}
+
+# request header / body 很大，只依比例抽樣輸出（預設 0 = 不輸出）
+header_log_sampler = LogSampler(Config.LOG_HEADERS_SAMPLE_RATE)
+body_log_sampler = LogSampler(Config.LOG_BODY_SAMPLE_RATE)
 
 @app.route("/", methods=['POST', 'GET'])
 def handle_root_requests():
-    logging.info(f"DEBUG: / route received a {request.method} request (acting as webhook).")
-    logging.info(f"DEBUG: Request URL: {request.url}")
-    logging.info(f"DEBUG: Request Headers:")
-    for header, value in request.headers.items():
-        logging.info(f"DEBUG:   {header}: {value}")
-
     if request.method == 'GET':
-        logging.info("INFO: Received GET request to / (likely health check or Line Webhook verification). Returning OK.")
+        logger.debug("Received GET request to / (likely health check or Line Webhook verification). Returning OK.")
         return "Hello, I am running! (Flask App on Hugging Face Spaces)", 200
 
+    timer = Timer()
+    if logger.isEnabledFor(logging.INFO) and header_log_sampler.sample():
+        logger.info("webhook headers", extra={"url": request.url, "headers": dict(request.headers)})
+
     if handler is None:
-        logging.error("ERROR: Line WebhookHandler is not initialized. Aborting POST request.")
+        logger.error("Line WebhookHandler is not initialized. Aborting POST request.")
         abort(500, description="Line WebhookHandler not initialized.")
 
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    if logger.isEnabledFor(logging.INFO) and body_log_sampler.sample():
+        logger.info("webhook body", extra={"body": body})
 
+    claimed_event_ids = []
+    duplicates = 0
     try:
         json_body = json.loads(body)
         if not json_body.get('events'):
-            logging.info("INFO: Received POST request to / with empty or no events. Returning OK for verification.")
+            logger.info("Received POST request to / with empty or no events. Returning OK for verification.")
             return 'OK', 200
 
-        handler.handle(body, signature)
+        if event_dispatcher is not None or batch_dispatcher is not None or event_deduplicator is not None:
+            if not handler.parser.signature_validator.validate(body, signature):
+                raise InvalidSignatureError('Invalid signature. signature=' + signature)
+
+        if event_deduplicator is not None:
+            # 重送的事件在碰資料庫、下載圖片之前就丟掉
+            events, claimed_event_ids = event_deduplicator.filter_events(json_body['events'])
+            duplicates = len(json_body['events']) - len(events)
+            if duplicates:
+                logger.info("Dropped %d redelivered webhook event(s).", duplicates)
+                if not events:
+                    metrics.webhook_events.labels("duplicate").inc(duplicates)
+                    return 'OK'
+                json_body = {**json_body, "events": events}
+                body = json.dumps(json_body, ensure_ascii=False)
+                signature = sign_webhook_body(Config.LINE_CHANNEL_SECRET, body)
+
+        if event_dispatcher is not None:
+            # 驗證簽章後排進佇列就回 200，實際處理交給背景 worker
+            event_dispatcher.submit(json_body, request.url_root)
+            metrics.queue_depth.set(event_dispatcher.depth())
+        elif batch_dispatcher is not None:
+            # 不同使用者的事件同時處理，全部完成才回 200
+            batch_dispatcher.dispatch(json_body, request.url_root)
+        else:
+            with line_bot_api.collect_replies():
+                handler.handle(body, signature)
     except InvalidSignatureError:
-        print("Invalid signature. Please check your channel access token/channel secret.")
-        logging.error("ERROR: Invalid signature. Check your channel access token/channel secret.")
+        logger.error("Invalid signature. Check your channel access token/channel secret.")
         abort(400)
     except json.JSONDecodeError:
-        logging.error("ERROR: Received non-JSON body to / POST request. Returning 400 Bad Request.")
+        logger.error("Received non-JSON body to / POST request. Returning 400 Bad Request.")
         abort(400, description="Invalid JSON format.")
+    except QueueFullError as e:
+        # 背景佇列滿了：沒排進去的事件取消登記並回 503，LINE 會依序重送
+        metrics.webhook_events.labels("rejected").inc(len(e.pending_event_ids))
+        if event_deduplicator is not None:
+            pending = set(e.pending_event_ids)
+            event_deduplicator.release([event_id for event_id in claimed_event_ids if event_id in pending])
+        abort(503)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        import traceback
-        logging.error(f"ERROR: An unexpected error occurred: {e}\n{traceback.format_exc()}")
+        logger.error("An unexpected error occurred: %s", e, exc_info=True)
+        if event_deduplicator is not None:
+            # 平行處理時只取消登記失敗的事件；其他使用者已經處理完的事件不能讓 LINE 重送時再做一次
+            if isinstance(e, BatchDispatchError):
+                failed = set(e.failed_event_ids)
+                event_deduplicator.release([event_id for event_id in claimed_event_ids if event_id in failed])
+            else:
+                event_deduplicator.release(claimed_event_ids)
         abort(500)
 
+    mode = "async" if event_dispatcher is not None else "sync"
+    metrics.webhook_latency.labels(mode).observe(timer.elapsed_ms / 1000)
+    metrics.webhook_events.labels("processed").inc(len(json_body['events']))
+    if duplicates:
+        metrics.webhook_events.labels("duplicate").inc(duplicates)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("webhook handled", extra={
+            "events": len(json_body['events']),
+            "duplicates": duplicates,
+            "bytes": len(body),
+            "mode": mode,
+            "duration_ms": timer.elapsed_ms,
+        })
     return 'OK'
 
 @handler.add(MessageEvent, message=TextMessage)
+@metrics.track_command("text_other")
 def handle_text_message(event):
     user_id = event.source.user_id
     user_message = event.message.text
     current_state_enum, current_item_id = db_manager.get_user_state(user_id)
-    
-    if user_message == "我撿到失物" or user_message == "上報失物":
-        new_item_id = db_manager.create_new_lost_item(user_id)
-        db_manager.update_user_state(user_id, UserState.REPORTING_WAIT_IMAGE, new_item_id)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="好的，請您依照以下步驟上報失物：\n1. 請先傳送失物的『圖片』。")
-        )
-        return
-
-    elif user_message == "找遺失物":
-        items = db_manager.retrieve_lost_items()
-        if items:
-            if FlexSendMessage:
-                flex_message = create_lost_items_flex_message(items)
-                line_bot_api.reply_message(event.reply_token, flex_message)
-            else:
-                logging.warning("FlexMessage not available. Sending text message instead.")
-                response_text = "目前有以下失物招領（由於 Flex Message 無法顯示）：\n"
-                for i, item in enumerate(items):
-                    description = item.get('description', '無')
-                    location = item.get('location', '無')
-                    report_date_str = item.get('report_date', '無').split('T')[0]
-                    response_text += f"\n--- 失物 #{i+1} ---\n描述: {description}\n位置: {location}\n日期: {report_date_str}\n"
-                    image_url = item.get('image_url', '')
-                    if image_url:
-                        response_text += f"圖片連結: {image_url}\n"
-                if len(response_text) > 2000:
-                    response_text = response_text[:1990] + "...\n(內容過長，請精簡)"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-        else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="目前沒有失物招領資訊。"))
-        return
 
-    elif user_message == "取消上報":
-        db_manager.clear_user_state(user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消失物上報。"))
+    # 指令表見下方 text_commands；整句相同的固定指令優先於上報流程的狀態，使用者隨時可以取消或查詢，
+    # 其他文字在等待描述 / 位置時一律交給上報流程，不會因為剛好以指令開頭就被搶走
+    command = text_commands.match(user_message, current_state_enum)
+    if command is not None:
+        metrics.set_command(command.name)
+        command.handler(event, user_id, current_item_id, command.argument)
         return
 
-    if current_state_enum == UserState.REPORTING_WAIT_DESCRIPTION:
-        if current_item_id:
-            db_manager.save_item_description(current_item_id, user_message)
-            db_manager.update_user_state(user_id, UserState.REPORTING_WAIT_LOCATION, current_item_id)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="好的，請您提供撿到失物的『位置』(可直接傳送 Line 的位置訊息，或輸入文字描述)。")
-            )
-        else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="上報流程錯誤，請重新開始『我撿到失物』。"))
-        return
-    
-    elif current_state_enum == UserState.REPORTING_WAIT_LOCATION:
-        if current_item_id:
-            db_manager.save_item_location(current_item_id, user_message)
-            db_manager.clear_user_state(user_id) 
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="感謝您上報失物！我們已將資訊發佈。")
-            )
-        else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="上報流程錯誤，請重新開始『我撿到失物』。"))
-        return
-
-    print(f"用戶發送了非指令/流程訊息: {user_message}，嘗試呼叫 AI")
+    logger.debug("用戶發送了非指令/流程訊息: %s，嘗試呼叫 AI", user_message)
     #ai_response = get_huggingface_response(user_message)
     #line_bot_api.reply_message(
         #event.reply_token,
         #TextSendMessage(text=ai_response))
 
+def command_start_report(event, user_id, current_item_id, argument):
+    db_manager.start_report(user_id, UserState.REPORTING_WAIT_IMAGE)
+    line_bot_api.reply_message(
+        event.reply_token,
+        TextSendMessage(text="好的，請您依照以下步驟上報失物：\n1. 請先傳送失物的『圖片』。")
+    )
+
+def command_list_lost_items(event, user_id, current_item_id, argument):
+    reply_lost_items_page(event.reply_token)
+
+def command_search_lost_items(event, user_id, current_item_id, argument):
+    reply_search_results(event.reply_token, argument)
+
+def command_nearby_lost_items(event, user_id, current_item_id, argument):
+    # 上報流程進行中（狀態帶著 current_item_id）時不切換狀態，否則那筆上報會被默默丟掉
+    if current_item_id:
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="您目前有一筆失物上報尚未完成，請先完成上報，或輸入『取消上報』後再查詢附近失物。")
+        )
+        return
+    db_manager.update_user_state(user_id, UserState.NEARBY_WAIT_LOCATION)
+    line_bot_api.reply_message(
+        event.reply_token,
+        TextSendMessage(
+            text="請傳送您目前的『位置』，我會列出離您最近的失物。",
+            quick_reply=QuickReply(items=[QuickReplyButton(action=LocationAction(label="傳送目前位置"))]),
+        )
+    )
+
+def command_cancel_report(event, user_id, current_item_id, argument):
+    db_manager.clear_user_state(user_id)
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消失物上報。"))
+
+def command_report_description(event, user_id, current_item_id, argument):
+    if current_item_id:
+        db_manager.advance_report(user_id, current_item_id, {'description': event.message.text}, UserState.REPORTING_WAIT_LOCATION)
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="好的，請您提供撿到失物的『位置』(可直接傳送 Line 的位置訊息，或輸入文字描述)。")
+        )
+    else:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="上報流程錯誤，請重新開始『我撿到失物』。"))
+
+def command_report_location(event, user_id, current_item_id, argument):
+    if current_item_id:
+        db_manager.advance_report(user_id, current_item_id, {'location': event.message.text}, UserState.NONE)
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="感謝您上報失物！我們已將資訊發佈。")
+        )
+    else:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="上報流程錯誤，請重新開始『我撿到失物』。"))
+
 @handler.add(MessageEvent, message=ImageMessage)
+@metrics.track_command("image_other")
 def handle_image_message(event):
     user_id = event.source.user_id
     current_state_enum, current_item_id = db_manager.get_user_state(user_id)
 
     if current_state_enum == UserState.REPORTING_WAIT_IMAGE and current_item_id:
+        metrics.set_command("report_image")
         try:
+            # 分段下載並邊寫邊算雜湊，不把整張圖讀進記憶體；同一張圖只存一份
             message_content = line_bot_api.get_message_content(event.message.id)
-            image_data = message_content.content
+            stored = image_store.ingest(message_content.iter_content(chunk_size=image_store.chunk_size))
+            metrics.observe_image(stored.size, stored.duplicate)
+            if stored.duplicate:
+                logger.info("Image %s already stored, reusing existing file.", stored.digest)
 
-            original_filename = event.message.id + '.jpg'
-            unique_filename = f"{uuid.uuid4()}_{original_filename}"
+            image_url = upload_url(stored.filename)
+            thumbnail_url = upload_url(stored.carousel_filename) if stored.carousel_filename else None
 
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
+            logger.info("Generated image URL: %s", image_url)
 
-            local_file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-
-            with open(local_file_path, 'wb') as f:
-                f.write(image_data)
-
-            image_url = request.url_root.rstrip('/') + '/static/uploads/' + unique_filename
-            if not image_url.startswith('https://'): 
-                image_url = image_url.replace('http://', 'https://')
-            
-            logging.info(f"Generated image URL: {image_url}") 
-
-            db_manager.save_item_image_url(current_item_id, image_url)
-            db_manager.update_user_state(user_id, UserState.REPORTING_WAIT_DESCRIPTION, current_item_id)
+            db_manager.advance_report(
+                user_id, current_item_id,
+                {'image_url': image_url, 'thumbnail_url': thumbnail_url},
+                UserState.REPORTING_WAIT_DESCRIPTION,
+            )
 
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(text="圖片已接收！請輸入您撿到失物的詳細描述 (例如：物品名稱、顏色、品牌、特徵等)。")
             )
         except Exception as e:
-            logging.error(f"Error handling image message: {e}", exc_info=True) 
+            logger.error("Error handling image message: %s", e, exc_info=True)
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(text="圖片處理失敗，請再試一次。")
@@ -252,46 +548,205 @@ def handle_image_message(event):
         )
 
 @handler.add(MessageEvent, message=LocationMessage)
+@metrics.track_command("location_other")
 def handle_location_message(event):
     user_id = event.source.user_id
     current_state_enum, current_item_id = db_manager.get_user_state(user_id)
 
     if current_state_enum == UserState.REPORTING_WAIT_LOCATION and current_item_id:
+        metrics.set_command("report_location")
         # 獲取經緯度
         latitude = event.message.latitude
         longitude = event.message.longitude
 
         location_info = f"{latitude},{longitude}" 
 
-        db_manager.save_item_location(current_item_id, location_info)
-        db_manager.clear_user_state(user_id) 
+        db_manager.advance_report(
+            user_id, current_item_id,
+            {'location': location_info, 'latitude': latitude, 'longitude': longitude},
+            UserState.NONE,
+        )
 
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="位置已接收！感謝您完成失物上報。")
         )
+    elif current_state_enum == UserState.NEARBY_WAIT_LOCATION:
+        metrics.set_command("nearby_location")
+        db_manager.clear_user_state(user_id)
+        reply_nearby_lost_items(event.reply_token, event.message.latitude, event.message.longitude)
     else:
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="目前不支援位置訊息，請您先點選主選單的『我撿到失物』以開始上報流程。")
         )
 
-def create_lost_items_flex_message(items):
+LOST_ITEMS_PAGE_SIZE = 10
+MORE_LOST_ITEMS_ACTION = "more_lost_items"
+SEARCH_LOST_ITEMS_ACTION = "search_lost_items"
+SEARCH_LOST_ITEMS_COMMAND = "找遺失物"
+SEARCH_KEYWORD_MAX_LENGTH = 50
+# LINE 的 postback data 上限 300 字元
+POSTBACK_DATA_MAX_LENGTH = 300
+# 估算 postback 長度時假設的最大 offset（7 位數）
+SEARCH_OFFSET_MAX = 10 ** 7 - 1
+
+# 文字指令表；名稱同時是 /metrics 的 command label
+text_commands = (
+    CommandRouter()
+    .exact(["我撿到失物", "上報失物"], "report_start", command_start_report)
+    .exact("找遺失物", "list_lost_items", command_list_lost_items)
+    # 「找遺失物 <關鍵字>」只在沒有進行中的流程（或等待附近失物的位置）時當成搜尋
+    .prefix(SEARCH_LOST_ITEMS_COMMAND, "search_lost_items", command_search_lost_items, require_argument=True,
+            states=(UserState.NONE, UserState.NEARBY_WAIT_LOCATION), require_separator=True)
+    .exact("附近失物", "nearby_start", command_nearby_lost_items)
+    .exact("取消上報", "report_cancel", command_cancel_report)
+    .state(UserState.REPORTING_WAIT_DESCRIPTION, "report_description", command_report_description)
+    .state(UserState.REPORTING_WAIT_LOCATION, "report_location", command_report_location)
+    .compile()
+)
+
+def encode_lost_items_cursor(cursor):
+    report_date, item_id = cursor
+    return urlencode({"action": MORE_LOST_ITEMS_ACTION, "before_date": report_date, "before_id": item_id})
+
+def decode_lost_items_cursor(data):
+    params = parse_qs(data)
+    if params.get("action", [None])[0] != MORE_LOST_ITEMS_ACTION:
+        return None
+    report_date = params.get("before_date", [None])[0]
+    item_id = params.get("before_id", [None])[0]
+    if not report_date or not item_id:
+        return None
+    return report_date, item_id
+
+def encode_search_postback(keyword, offset):
+    return urlencode({"action": SEARCH_LOST_ITEMS_ACTION, "q": keyword, "offset": offset})
+
+def clip_search_keyword(keyword):
+    # 關鍵字在 postback data 裡會被 urlencode（一個中文字變成 9 個字元），
+    # 所以依編碼後的長度截斷，換頁按鈕的 data 才不會超過 LINE 的上限而讓整個回覆被拒
+    keyword = keyword[:SEARCH_KEYWORD_MAX_LENGTH]
+    while keyword and len(encode_search_postback(keyword, SEARCH_OFFSET_MAX)) > POSTBACK_DATA_MAX_LENGTH:
+        keyword = keyword[:-1]
+    return keyword
+
+def decode_search_postback(data):
+    params = parse_qs(data)
+    if params.get("action", [None])[0] != SEARCH_LOST_ITEMS_ACTION:
+        return None
+    keyword = params.get("q", [None])[0]
+    try:
+        offset = int(params.get("offset", ["0"])[0])
+    except ValueError:
+        return None
+    if not keyword or offset < 0:
+        return None
+    return keyword, offset
+
+def render_lost_items_page(before=None):
+    items, next_cursor = db_manager.retrieve_lost_items_page(limit=LOST_ITEMS_PAGE_SIZE, before=before)
+    if not items:
+        empty_text = "目前沒有失物招領資訊。" if before is None else "沒有更多失物了。"
+        empty_json = json.dumps(TextSendMessage(text=empty_text).as_json_dict(), ensure_ascii=False)
+        return empty_json, empty_json, True
+    more_data = encode_lost_items_cursor(next_cursor) if next_cursor else None
+    text_json = json.dumps(create_lost_items_text_message(items, more_data).as_json_dict(), ensure_ascii=False)
+    flex_json = None
+    if FlexSendMessage:
+        flex_json = json.dumps(create_lost_items_flex_message(items, more_data).as_json_dict(), ensure_ascii=False)
+    return flex_json, text_json, False
+
+def reply_lost_items_page(reply_token, before=None):
+    # 列表只在上報完成或失物結案時才會變動，直接用快取好的 JSON 回覆
+    page = lost_items_render_cache.get(
+        before,
+        db_manager.get_listing_epoch(),
+        lambda: render_lost_items_page(before),
+    )
+    if page.flex_json:
+        line_bot_api.reply_message(reply_token, PreserializedMessage(page.flex_json))
+    else:
+        if not page.is_empty:
+            logger.warning("FlexMessage not available. Sending text message instead.")
+        line_bot_api.reply_message(reply_token, PreserializedMessage(page.text_json))
+
+def reply_search_results(reply_token, keyword, offset=0):
+    # 搜尋結果依關鍵字而異，不放進列表的 render cache；FTS 查詢本身是毫秒等級
+    keyword = clip_search_keyword(keyword)
+    timer = Timer()
+    items, next_offset = db_manager.search_lost_items(keyword, limit=LOST_ITEMS_PAGE_SIZE, offset=offset)
+    logger.info("lost item search", extra={"keyword": keyword, "offset": offset, "results": len(items), "duration_ms": timer.elapsed_ms})
+    if not items:
+        empty_text = f"找不到與「{keyword}」相關的失物。" if offset == 0 else "沒有更多相符的失物了。"
+        line_bot_api.reply_message(reply_token, TextSendMessage(text=empty_text))
+        return
+    more_data = encode_search_postback(keyword, next_offset) if next_offset is not None else None
+    if FlexSendMessage:
+        line_bot_api.reply_message(reply_token, create_lost_items_flex_message(items, more_data, alt_text=f"「{keyword}」的搜尋結果"))
+    else:
+        logger.warning("FlexMessage not available. Sending text message instead.")
+        line_bot_api.reply_message(reply_token, create_lost_items_text_message(items, more_data))
+
+def reply_nearby_lost_items(reply_token, latitude, longitude):
+    timer = Timer()
+    items = db_manager.find_lost_items_near(latitude, longitude, limit=LOST_ITEMS_PAGE_SIZE, max_radius_m=Config.NEARBY_MAX_RADIUS_M)
+    logger.info("nearby lost items", extra={"results": len(items), "duration_ms": timer.elapsed_ms})
+    if not items:
+        line_bot_api.reply_message(
+            reply_token,
+            TextSendMessage(text=f"您附近 {format_distance(Config.NEARBY_MAX_RADIUS_M)} 內沒有失物招領資訊。")
+        )
+        return
+    if FlexSendMessage:
+        line_bot_api.reply_message(reply_token, create_lost_items_flex_message(items, alt_text="您附近的失物招領"))
+    else:
+        logger.warning("FlexMessage not available. Sending text message instead.")
+        line_bot_api.reply_message(reply_token, create_lost_items_text_message(items))
+
+def format_distance(meters):
+    if meters < 1000:
+        return f"{int(round(meters))} 公尺"
+    return f"{meters / 1000:.1f} 公里"
+
+@handler.add(PostbackEvent)
+@metrics.track_command("postback_other")
+def handle_postback(event):
+    before = decode_lost_items_cursor(event.postback.data)
+    if before is not None:
+        metrics.set_command("list_lost_items_more")
+        reply_lost_items_page(event.reply_token, before=before)
+        return
+    search = decode_search_postback(event.postback.data)
+    if search is not None:
+        metrics.set_command("search_lost_items_more")
+        reply_search_results(event.reply_token, *search)
+        return
+    logger.info("Ignoring unknown postback data: %s", event.postback.data)
+
+def create_lost_items_text_message(items, more_data=None):
+    response_text = "目前有以下失物招領（由於 Flex Message 無法顯示）：\n"
+    for i, item in enumerate(items):
+        description = item.get('description', '無')
+        location = item.get('location', '無')
+        report_date_str = item.get('report_date', '無').split('T')[0]
+        response_text += f"\n--- 失物 #{i+1} ---\n描述: {description}\n位置: {location}\n日期: {report_date_str}\n"
+        if item.get('distance_m') is not None:
+            response_text += f"距離: 約 {format_distance(item['distance_m'])}\n"
+        image_url = item.get('image_url', '')
+        if image_url:
+            response_text += f"圖片連結: {image_url}\n"
+    if more_data:
+        response_text += "\n(僅顯示最新的失物招領)\n"
+    if len(response_text) > 2000:
+        response_text = response_text[:1990] + "...\n(內容過長，請精簡)"
+    return TextSendMessage(text=response_text)
+
+def create_lost_items_flex_message(items, more_data=None, alt_text="失物招領資訊"):
   
     if not FlexSendMessage or not BubbleContainer or not CarouselContainer or not BoxComponent or not TextComponent or not ImageComponent or not ButtonComponent or not URIAction:
-        logging.warning("Flex Message components are not fully available. Returning a simple text message.")
-        response_text = "目前有以下失物招領（由於 Flex Message 無法顯示）：\n"
-        for i, item in enumerate(items):
-            description = item.get('description', '無')
-            location = item.get('location', '無')
-            report_date_str = item.get('report_date', '無').split('T')[0]
-            response_text += f"\n--- 失物 #{i+1} ---\n描述: {description}\n位置: {location}\n日期: {report_date_str}\n"
-            image_url = item.get('image_url', '')
-            if image_url:
-                response_text += f"圖片連結: {image_url}\n"
-        if len(response_text) > 2000:
-            response_text = response_text[:1990] + "...\n(內容過長，請精簡)"
-        return TextSendMessage(text=response_text)
+        logger.warning("Flex Message components are not fully available. Returning a simple text message.")
+        return create_lost_items_text_message(items, more_data)
 
     if not items:
         return TextSendMessage(text="目前沒有失物招領資訊。")
@@ -299,14 +754,24 @@ def create_lost_items_flex_message(items):
     bubbles = []
     for item in items:
         location = str(item.get("location", "") or "")
-        is_latlng = re.match(r'^-?\d+(\.\d+)?\s*,\s*-?\d+(\.\d+)?$', location.strip())
+        latitude, longitude = item.get("latitude"), item.get("longitude")
+
+        map_url = None
+        if latitude is not None and longitude is not None:
+            map_url = f"https://www.google.com/maps/search/?api=1&query={quote(f'{latitude},{longitude}')}"
 
-        map_url = f"https://www.google.com/maps/search/?api=1&query={quote(location)}" if is_latlng else None
+        body_contents = [
+            TextComponent(text=f"描述: {item.get('description', '無')}", wrap=True, size='md'),
+            TextComponent(text=f"位置: {location}", wrap=True, size='sm', color='#666666'),
+            TextComponent(text=f"日期: {item.get('report_date', '無').split('T')[0]}", wrap=True, size='sm', color='#666666'),
+        ]
+        if item.get('distance_m') is not None:
+            body_contents.append(TextComponent(text=f"距離: 約 {format_distance(item['distance_m'])}", wrap=True, size='sm', color='#666666'))
 
         bubble = BubbleContainer(
             direction='ltr',
             hero=ImageComponent(
-                url=item.get('image_url', 'https://via.placeholder.com/450x300?text=No+Image'),
+                url=item.get('thumbnail_url') or item.get('image_url', 'https://via.placeholder.com/450x300?text=No+Image'),
                 size='full',
                 aspect_ratio='20:13',
                 aspect_mode='cover',
@@ -314,11 +779,7 @@ def create_lost_items_flex_message(items):
             ),
             body=BoxComponent(
                 layout='vertical',
-                contents=[
-                    TextComponent(text=f"描述: {item.get('description', '無')}", wrap=True, size='md'),
-                    TextComponent(text=f"位置: {location}", wrap=True, size='sm', color='#666666'),
-                    TextComponent(text=f"日期: {item.get('report_date', '無').split('T')[0]}", wrap=True, size='sm', color='#666666'),
-                ]
+                contents=body_contents
             ),
             footer=BoxComponent(
                 layout='vertical',
@@ -334,9 +795,33 @@ def create_lost_items_flex_message(items):
         )
 
         bubbles.append(bubble)
-        if len(bubbles) >= 10:
+        if len(bubbles) >= LOST_ITEMS_PAGE_SIZE:
             break
 
-    return FlexSendMessage(alt_text="失物招領資訊", contents=CarouselContainer(contents=bubbles))
+    # 還有下一頁時，在最後補一張「查看更多」卡片，點擊後以 postback (more_data) 取下一頁
+    if more_data:
+        bubbles.append(BubbleContainer(
+            direction='ltr',
+            body=BoxComponent(
+                layout='vertical',
+                contents=[
+                    TextComponent(text="還有更多失物招領", wrap=True, size='md', weight='bold'),
+                ]
+            ),
+            footer=BoxComponent(
+                layout='vertical',
+                spacing='sm',
+                contents=[
+                    ButtonComponent(
+                        style='primary',
+                        height='sm',
+                        action=PostbackAction(label='查看更多', data=more_data, display_text='查看更多失物')
+                    )
+                ]
+            )
+        ))
+
+    return FlexSendMessage(alt_text=alt_text, contents=CarouselContainer(contents=bubbles))
 
-logging.info("INFO: Flask application is fully initialized.")
+startup_timer.mark("routes")
+logger.info("Flask application is fully initialized.", extra=startup_timer.as_dict())
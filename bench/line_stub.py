@@ -0,0 +1,161 @@
+"""
+本機的 LINE Messaging API stub，給壓測與測試使用。
+
+- POST /v2/bot/message/reply：記錄 replyToken 與收到的時間，回傳 {}
+- GET  /v2/bot/message/<id>/content：回傳一張固定的 JPEG
+- fail_next(n, status) 讓接下來 n 個 request 回傳錯誤，用來測試重試
+"""
+import io
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_PATH_PATTERN = re.compile(r'^/v2/bot/message/([^/]+)/content$')
+
+
+def _make_jpeg(width=1280, height=960):
+    try:
+        from PIL import Image
+    except ImportError:
+        # 沒有 Pillow 時用最小的合法 JPEG 頭尾湊一個假檔，大小仍然接近真實照片
+        return b'\xff\xd8\xff\xe0' + b'\x00' * (200 * 1024) + b'\xff\xd9'
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (120, 160, 200)).save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+class LineApiStub:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, image_bytes=None):
+        self.latency = latency
+        self.image_bytes = image_bytes if image_bytes is not None else _make_jpeg()
+        self.replies = {}
+        self.reply_count = 0
+        self.content_count = 0
+        self.request_count = 0
+        self.failed_count = 0
+        self._fail_remaining = 0
+        self._fail_status = 500
+        self._connections = set()
+        self._cond = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="line-api-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next(self, count, status=500):
+        with self._cond:
+            self._fail_remaining = count
+            self._fail_status = status
+
+    def _should_fail(self):
+        with self._cond:
+            self.request_count += 1
+            if self._fail_remaining > 0:
+                self._fail_remaining -= 1
+                self.failed_count += 1
+                return self._fail_status
+            return None
+
+    @property
+    def connection_count(self):
+        # 曾經連進來的 TCP 連線數，用來確認 client 有沒有重用連線
+        return len(self._connections)
+
+    def wait_for_reply(self, reply_token, timeout=10.0):
+        """等到某個 replyToken 被回覆，回傳 (收到的時間, messages)；逾時回傳 None。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while reply_token not in self.replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self.replies.pop(reply_token)
+
+    def _record_reply(self, payload):
+        with self._cond:
+            self.reply_count += 1
+            self.replies[payload.get('replyToken')] = (time.perf_counter(), payload.get('messages', []))
+            self._cond.notify_all()
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # keep-alive 時 header 與 body 分兩次寫出，沒關 Nagle 會被 delayed ACK 卡 40ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                stub._connections.add(self.client_address)
+
+            def _send(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                if stub.latency:
+                    time.sleep(stub.latency)
+                fail_status = stub._should_fail()
+                if fail_status:
+                    self._send(fail_status, b'{"message": "Injected failure"}')
+                elif self.path == '/v2/bot/message/reply':
+                    stub._record_reply(json.loads(raw or b'{}'))
+                    self._send(200, b'{}')
+                else:
+                    self._send(404, b'{"message": "Not found"}')
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                fail_status = stub._should_fail()
+                if fail_status:
+                    self._send(fail_status, b'{"message": "Injected failure"}')
+                elif CONTENT_PATH_PATTERN.match(self.path):
+                    with stub._cond:
+                        stub.content_count += 1
+                    self._send(200, stub.image_bytes, content_type='image/jpeg')
+                else:
+                    self._send(404, b'{"message": "Not found"}')
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local LINE Messaging API stub.')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of artificial latency per call')
+    args = parser.parse_args()
+    stub = LineApiStub(port=args.port, latency=args.latency).start()
+    print(f"LINE API stub listening on {stub.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
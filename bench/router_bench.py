@@ -0,0 +1,103 @@
+"""
+command_router.py 的微型壓測。
+
+比較兩種分派方式在指令表變大時的耗時：
+- linear：原本的 if / elif 寫法，依序對每個關鍵字做 `keyword in message`
+- router：CommandRouter 把所有關鍵字編成一個 Aho-Corasick 比對器，一則訊息只掃一次
+
+    python bench/router_bench.py
+    python bench/router_bench.py --sizes 10 100 1000 10000 --messages 2000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from command_router import CommandRouter
+
+# 產生關鍵字用的字元：常用中文字 + 英文小寫
+ALPHABET = "的一是不了人我在有他這中大來上國個到說們為子和你地出道也時年得就那要下以生會自着去之過家學對可她裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三已老從動兩長abcdefghijklmnopqrstuvwxyz"
+
+
+def random_keyword(rng):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(2, 5)))
+
+
+def build_table(size, rng):
+    keywords = []
+    seen = set()
+    while len(keywords) < size:
+        keyword = random_keyword(rng)
+        if keyword not in seen:
+            seen.add(keyword)
+            keywords.append(keyword)
+    return keywords
+
+
+def build_messages(keywords, count, rng):
+    # 一半是不含任何指令的閒聊，一半各含一個隨機關鍵字（包含排在最後面的）
+    messages = []
+    for index in range(count):
+        filler = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(4, 30)))
+        if index % 2:
+            cut = rng.randint(0, len(filler))
+            filler = filler[:cut] + rng.choice(keywords) + filler[cut:]
+        messages.append(filler)
+    return messages
+
+
+def linear_dispatch(keywords, message):
+    for index, keyword in enumerate(keywords):
+        if keyword in message:
+            return index
+    return None
+
+
+def measure(func, messages, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for message in messages:
+            func(message)
+        best = min(best, time.perf_counter() - started)
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CommandRouter against a linear if/elif keyword chain.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 64, 512, 4096])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'keywords':>9} {'linear us':>10} {'router us':>10} {'compile ms':>11} {'agree':>6}")
+    for size in args.sizes:
+        keywords = build_table(size, rng)
+        messages = build_messages(keywords, args.messages, rng)
+
+        router = CommandRouter()
+        for index, keyword in enumerate(keywords):
+            router.contains(keyword, index)
+        started = time.perf_counter()
+        router.compile()
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        def routed(message):
+            match = router.match(message)
+            return match.name if match else None
+
+        # 兩種做法選出的指令要一致（同時符合多個時都取排在前面的）
+        agree = all(linear_dispatch(keywords, message) == routed(message) for message in messages)
+        linear_us = measure(lambda message: linear_dispatch(keywords, message), messages, args.repeat)
+        router_us = measure(routed, messages, args.repeat)
+        print(f"{size:>9} {linear_us:>10.2f} {router_us:>10.2f} {compile_ms:>11.1f} {str(agree):>6}")
+
+
+if __name__ == "__main__":
+    main()
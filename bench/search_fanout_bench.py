@@ -0,0 +1,140 @@
+"""
+teacher_recommend/search_fanout.py 對本機假搜尋伺服器的壓測。
+
+假伺服器依查詢字串決定行為，可以模擬上游慢、失敗或偶爾卡住的情況：
+- 查詢含 "slow" 的固定要等 --slow 秒才回應
+- 查詢含 "fail" 的回 503
+- 其他查詢有 --stall-rate 的機率卡住 --slow 秒（hedge 要處理的長尾），否則延遲 --latency 秒
+每個查詢回傳兩筆假的 Dcard 網址，部分網址在不同查詢間重複，用來確認去重。
+
+比較兩種做法：
+- sequential：原本的寫法，一種查詢寫法接著一種、失敗就重試
+- fanout：FanOutSearch 同時送出所有寫法、hedge 慢的 request、湊滿三篇就回傳
+
+    python bench/search_fanout_bench.py
+    python bench/search_fanout_bench.py --searches 50 --stall-rate 0.3
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "teacher_recommend"))
+
+from search_fanout import FanOutSearch, dedupe_key
+
+
+def make_handler(args, rng):
+    class StubSearchHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query).get("q", [""])[0]
+            if "fail" in query:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if "slow" in query or rng.random() < args.stall_rate:
+                time.sleep(args.slow)
+            else:
+                time.sleep(args.latency)
+            # 第一筆網址依查詢不同，第二筆所有查詢都一樣（加上不同的 query string）
+            body = (f"{query} 1\thttps://www.dcard.tw/f/scu/p/{abs(hash(query)) % 100000}\n"
+                    f"{query} 2\thttps://dcard.tw/f/scu/p/1?ref={len(query)}\n")
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+            except (BrokenPipeError, ConnectionResetError):
+                # fanout 拿到足夠結果後不會等其他 request，連線被關掉是正常的
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubSearchHandler
+
+
+def parse_lines(text):
+    results = []
+    for line in text.splitlines():
+        title, url = line.split("\t")
+        results.append({"title": title, "url": url, "description": ""})
+    return results
+
+
+def sequential_search(url, queries, want, timeout, retries=2):
+    # 原本 scudcard 的寫法：一次一個 request，失敗就再試
+    merged = {}
+    for query in queries:
+        for _ in range(retries):
+            try:
+                response = requests.get(url, params={"q": query}, timeout=timeout)
+                response.raise_for_status()
+            except requests.RequestException:
+                continue
+            for hit in parse_lines(response.text):
+                merged.setdefault(dedupe_key(hit["url"]), hit)
+            break
+        if len(merged) >= want:
+            break
+    return list(merged.values())[:want]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FanOutSearch against sequential searching on a local stub.")
+    parser.add_argument("--searches", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow", type=float, default=3.0)
+    parser.add_argument("--stall-rate", type=float, default=0.2)
+    parser.add_argument("--deadline", type=float, default=2.0)
+    parser.add_argument("--hedge-after", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args, random.Random(args.seed)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/html/"
+    engine = FanOutSearch(url, parse_lines, want=3, deadline=args.deadline, hedge_after=args.hedge_after)
+
+    scenarios = {
+        "normal": ["東吳 中文系 推薦教授", "東吳 中國文學系 推薦教授", "東吳 中文系 推薦老師", "東吳 中國文學系 推薦老師"],
+        "one slow": ["東吳 slow 推薦教授", "東吳 中國文學系 推薦教授", "東吳 中文系 推薦老師", "東吳 中國文學系 推薦老師"],
+        "one failing": ["東吳 fail 推薦教授", "東吳 中國文學系 推薦教授", "東吳 中文系 推薦老師", "東吳 中國文學系 推薦老師"],
+    }
+    print(f"{'scenario':>12} {'mode':>10} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'hits':>5}")
+    try:
+        for name, queries in scenarios.items():
+            for mode in ("sequential", "fanout"):
+                timings, hits = [], []
+                for _ in range(args.searches):
+                    started = time.perf_counter()
+                    if mode == "fanout":
+                        try:
+                            results = engine.search(queries)
+                        except TimeoutError:
+                            results = []
+                    else:
+                        results = sequential_search(url, queries, 3, timeout=10)
+                    timings.append((time.perf_counter() - started) * 1000)
+                    hits.append(len(results))
+                print(f"{name:>12} {mode:>10} {percentile(timings, 0.5):>8.0f} {percentile(timings, 0.95):>8.0f} "
+                      f"{max(timings):>8.0f} {min(hits):>5}")
+        print("fanout stats:", engine.stats())
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+app.py 的 webhook 壓測工具。
+
+產生有正確 X-Line-Signature 的 LINE webhook 事件，模擬多位使用者同時操作：
+「我撿到失物」→ 圖片 → 描述 → 位置 的完整上報流程，以及「找遺失物」列表。
+LINE Messaging API 由 bench/line_stub.py 的本機 stub 取代，
+每個指令分別統計 ack（webhook 回 200）與 reply（stub 收到回覆）的 p50 / p99 延遲與吞吐量。
+
+在同一個行程內啟動 app.py（預設）：
+    python bench/webhook_bench.py --users 50 --concurrency 8
+
+壓測已經在跑的服務（該服務要用相同的 channel secret，並把 LINE_API_ENDPOINT /
+LINE_API_DATA_ENDPOINT 指到 --stub-port）：
+    python bench/webhook_bench.py --url http://127.0.0.1:7860/ --stub-port 8099 --secret bench-secret
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+from event_queue import sign_webhook_body
+from line_stub import LineApiStub
+
+
+class EventFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def _base(self, user_id, event_type='message'):
+        n = self._next_id()
+        return n, {
+            "type": event_type,
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "replyToken": f"bench-reply-{n}",
+            "webhookEventId": f"bench-event-{n}",
+            "deliveryContext": {"isRedelivery": False},
+        }
+
+    def text(self, user_id, text):
+        n, event = self._base(user_id)
+        event["message"] = {"type": "text", "id": str(n), "text": text}
+        return event
+
+    def image(self, user_id):
+        n, event = self._base(user_id)
+        event["message"] = {"type": "image", "id": f"bench-image-{n}", "contentProvider": {"type": "line"}}
+        return event
+
+    def location(self, user_id, latitude=25.0947, longitude=121.5448):
+        n, event = self._base(user_id)
+        event["message"] = {"type": "location", "id": str(n), "title": "東吳大學",
+                            "address": "台北市士林區臨溪路70號", "latitude": latitude, "longitude": longitude}
+        return event
+
+
+class Recorder:
+    def __init__(self):
+        self.ack = defaultdict(list)
+        self.reply = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, command, ack_ms, reply_ms, ok):
+        with self._lock:
+            self.ack[command].append(ack_ms)
+            if reply_ms is not None:
+                self.reply[command].append(reply_ms)
+            if not ok:
+                self.errors[command] += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Bench:
+    def __init__(self, url, stub, secret, recorder, reply_timeout=10.0):
+        self.url = url
+        self.stub = stub
+        self.secret = secret
+        self.recorder = recorder
+        self.reply_timeout = reply_timeout
+        self.events = EventFactory()
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, command, event):
+        body = json.dumps({"destination": "bench", "events": [event]}, ensure_ascii=False)
+        headers = {"Content-Type": "application/json", "X-Line-Signature": sign_webhook_body(self.secret, body)}
+        started = time.perf_counter()
+        try:
+            response = self._session().post(self.url, data=body.encode('utf-8'), headers=headers, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        ack_ms = (time.perf_counter() - started) * 1000
+
+        reply_ms = None
+        if ok:
+            reply = self.stub.wait_for_reply(event["replyToken"], timeout=self.reply_timeout)
+            if reply is None:
+                ok = False
+            else:
+                reply_ms = (reply[0] - started) * 1000
+        self.recorder.add(command, ack_ms, reply_ms, ok)
+
+    def run_user(self, index, finds_per_user):
+        user_id = f"Ubench{index:05d}"
+        self.send("我撿到失物", self.events.text(user_id, "我撿到失物"))
+        self.send("report:image", self.events.image(user_id))
+        self.send("report:description", self.events.text(user_id, f"壓測用的黑色錢包 #{index}"))
+        self.send("report:location", self.events.location(user_id))
+        for _ in range(finds_per_user):
+            self.send("找遺失物", self.events.text(user_id, "找遺失物"))
+
+
+def start_in_process_app(stub, secret, workdir):
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": secret,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_API_ENDPOINT": stub.url,
+        "LINE_API_DATA_ENDPOINT": stub.url,
+        "SQLITE_DB_PATH": os.path.join(workdir, "bench.db"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app as lost_and_found
+    from werkzeug.serving import make_server
+
+    # werkzeug 每個 request 一行的 access log 會蓋掉壓測結果
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, lost_and_found.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/"
+
+
+def print_report(recorder, wall_seconds):
+    header = f"{'command':<22}{'n':>6}{'err':>5}{'ack p50':>10}{'ack p99':>10}{'reply p50':>11}{'reply p99':>11}{'req/s':>9}"
+    print(header)
+    print("-" * len(header))
+    total = 0
+    for command in recorder.ack:
+        ack = recorder.ack[command]
+        reply = recorder.reply[command]
+        total += len(ack)
+        print(f"{command:<22}{len(ack):>6}{recorder.errors[command]:>5}"
+              f"{percentile(ack, 50):>10.1f}{percentile(ack, 99):>10.1f}"
+              f"{percentile(reply, 50):>11.1f}{percentile(reply, 99):>11.1f}"
+              f"{len(ack) / wall_seconds:>9.1f}")
+    print("-" * len(header))
+    print(f"total {total} events in {wall_seconds:.2f}s = {total / wall_seconds:.1f} events/s (latencies in ms)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Signed-webhook load generator for app.py")
+    parser.add_argument("--url", help="webhook URL of a running app; default starts app.py in-process")
+    parser.add_argument("--secret", default="bench-secret", help="LINE channel secret used for signing")
+    parser.add_argument("--stub-port", type=int, default=0, help="port for the LINE API stub (0 = random)")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="artificial LINE API latency in seconds")
+    parser.add_argument("--users", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=4, help="users running at the same time")
+    parser.add_argument("--finds", type=int, default=3, help="找遺失物 requests per user after reporting")
+    parser.add_argument("--reply-timeout", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    stub = LineApiStub(port=args.stub_port, latency=args.stub_latency).start()
+    server = None
+    workdir = tempfile.mkdtemp(prefix="webhook-bench-")
+    url = args.url
+    if not url:
+        server, url = start_in_process_app(stub, args.secret, workdir)
+
+    recorder = Recorder()
+    bench = Bench(url, stub, args.secret, recorder, reply_timeout=args.reply_timeout)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda index: bench.run_user(index, args.finds), range(args.users)))
+    wall_seconds = time.perf_counter() - started
+
+    print_report(recorder, wall_seconds)
+    print(f"LINE stub: {stub.reply_count} replies, {stub.content_count} content downloads; workdir {workdir}")
+
+    if server is not None:
+        server.shutdown()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+from collections import deque, namedtuple
+
+# 比對結果：name 是指令名稱（也用在 metrics label），argument 是關鍵字後面的文字（prefix 規則才有）
+CommandMatch = namedtuple("CommandMatch", ["name", "handler", "kind", "keyword", "argument"])
+_Rule = namedtuple("_Rule", ["order", "name", "handler", "kind", "keyword", "require_argument", "states", "require_separator"])
+
+EXACT = "exact"
+PREFIX = "prefix"
+CONTAINS = "contains"
+STATE = "state"
+
+
+class AhoCorasick:
+    """
+    純 Python 的 Aho-Corasick 多字串比對。
+
+    所有關鍵字先建成一棵 trie 加上失敗連結，掃一次文字就能找出所有出現的關鍵字，
+    耗時只跟文字長度有關，不會隨關鍵字數量變長。
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for index, pattern in enumerate(self.patterns):
+            self._insert(pattern, index)
+        self._build_failure_links()
+
+    def _insert(self, pattern, index):
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            node = next_node
+        self._output[node] += (index,)
+
+    def _build_failure_links(self):
+        # BFS：每個節點的失敗連結指向「目前字串最長的、也在 trie 裡的後綴」
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # 後綴上的關鍵字也算出現在這個節點
+                self._output[child] += self._output[self._fail[child]]
+
+    def iter_matches(self, text):
+        """依結束位置產生 (開始位置, 關鍵字索引)。"""
+        lengths = [len(pattern) for pattern in self.patterns]
+        for end, indexes in self.scan(text):
+            for index in indexes:
+                yield end - lengths[index], index
+
+    def scan(self, text):
+        """回傳 [(結束位置 + 1, 關鍵字索引 tuple), ...]；不用 generator，少一層函式呼叫。"""
+        goto, fail, output = self._goto, self._fail, self._output
+        found = []
+        node = 0
+        position = 0
+        for char in text:
+            position += 1
+            edges = goto[node]
+            while node and char not in edges:
+                node = fail[node]
+                edges = goto[node]
+            node = edges.get(char, 0)
+            if output[node]:
+                found.append((position, output[node]))
+        return found
+
+
+class CommandRouter:
+    """
+    表格式的指令路由。
+
+    規則依種類的優先順序比對：exact（整句相同）→ state（使用者目前的對話狀態）→
+    prefix（開頭是關鍵字）→ contains（句子裡有關鍵字）；
+    state 排在 prefix 前面，流程進行中的自由文字才不會因為剛好以關鍵字開頭就被搶走。
+    同一種類有多條規則符合時，先註冊的優先，與原本 if / elif 的順序一致。
+    prefix / contains 規則可以用 states= 限定只在某些對話狀態下生效。
+    prefix 與 contains 的關鍵字編成同一個 Aho-Corasick 比對器，一則訊息只掃一次。
+    """
+
+    def __init__(self, normalize=None):
+        self.normalize = normalize
+        self._rules = []
+        self._exact = {}
+        self._states = {}
+        self._matcher = None
+        self._keyword_rules = []
+        self._keyword_lengths = []
+        self._scan_limit = None
+
+    def _add(self, kind, keyword, name, handler, require_argument=False, states=None, require_separator=False):
+        states = None if states is None else frozenset(_as_tuple(states))
+        rule = _Rule(len(self._rules), name, handler, kind, keyword, require_argument, states, require_separator)
+        self._rules.append(rule)
+        self._matcher = None
+        return rule
+
+    def _normalize(self, text):
+        return self.normalize(text) if self.normalize else text
+
+    def exact(self, keywords, name, handler=None):
+        for keyword in _as_tuple(keywords):
+            rule = self._add(EXACT, self._normalize(keyword), name, handler)
+            self._exact.setdefault(rule.keyword, rule)
+        return self
+
+    def prefix(self, keywords, name, handler=None, require_argument=False, states=None, require_separator=False):
+        # require_separator=True 時關鍵字後面要先接空白（含全形空白）才算，「找遺失物的時候…」不會被當成指令
+        for keyword in _as_tuple(keywords):
+            self._add(PREFIX, self._normalize(keyword), name, handler, require_argument, states, require_separator)
+        return self
+
+    def contains(self, keywords, name, handler=None, states=None):
+        for keyword in _as_tuple(keywords):
+            self._add(CONTAINS, self._normalize(keyword), name, handler, states=states)
+        return self
+
+    def state(self, states, name, handler=None):
+        for state in _as_tuple(states):
+            rule = self._add(STATE, state, name, handler)
+            self._states.setdefault(state, rule)
+        return self
+
+    def compile(self):
+        # 同一個關鍵字可能同時有 prefix 與 contains 規則，trie 裡只放一份
+        keywords = {}
+        for rule in self._rules:
+            if rule.kind in (PREFIX, CONTAINS) and rule.keyword:
+                keywords.setdefault(rule.keyword, []).append(rule)
+        self._keyword_rules = list(keywords.values())
+        self._keyword_lengths = [len(keyword) for keyword in keywords]
+        # 只有 prefix 規則時，掃到最長的關鍵字長度就夠了，不必掃完整則訊息
+        if any(rule.kind == CONTAINS for rule in self._rules):
+            self._scan_limit = None
+        else:
+            self._scan_limit = max(self._keyword_lengths, default=0)
+        self._matcher = AhoCorasick(keywords)
+        return self
+
+    def match(self, text, state=None):
+        """回傳 CommandMatch；沒有任何規則符合時回傳 None。"""
+        if self._matcher is None:
+            self.compile()
+        text = self._normalize(text)
+
+        rule = self._exact.get(text)
+        if rule is not None:
+            return CommandMatch(rule.name, rule.handler, EXACT, rule.keyword, "")
+        if state is not None:
+            rule = self._states.get(state)
+            if rule is not None:
+                return CommandMatch(rule.name, rule.handler, STATE, None, "")
+
+        best_prefix = best_contains = None
+        prefix_argument = ""
+        scanned = text if self._scan_limit is None else text[:self._scan_limit]
+        for end, indexes in self._matcher.scan(scanned):
+            for index in indexes:
+                for rule in self._keyword_rules[index]:
+                    if rule.states is not None and state not in rule.states:
+                        continue
+                    if rule.kind == CONTAINS:
+                        if best_contains is None or rule.order < best_contains.order:
+                            best_contains = rule
+                    elif end == self._keyword_lengths[index] and (best_prefix is None or rule.order < best_prefix.order):
+                        rest = text[end:]
+                        if rule.require_separator and rest and not rest[0].isspace():
+                            continue
+                        argument = rest.strip()
+                        if argument or not rule.require_argument:
+                            best_prefix, prefix_argument = rule, argument
+
+        if best_prefix is not None:
+            return CommandMatch(best_prefix.name, best_prefix.handler, PREFIX, best_prefix.keyword, prefix_argument)
+        if best_contains is not None:
+            return CommandMatch(best_contains.name, best_contains.handler, CONTAINS, best_contains.keyword, "")
+        return None
+
+    def __len__(self):
+        return len(self._rules)
+
+
+def _as_tuple(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(value)
+    return (value,)
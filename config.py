@@ -3,9 +3,82 @@ import os
 class Config:
     LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
     LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
-    SQLITE_DB_PATH = '/tmp/lost_items.db' 
-    UPLOAD_FOLDER = '/tmp/uploads'
+    # 壓測或測試時可以把 LINE API 指到本機的 stub server
+    LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT', 'https://api.line.me')
+    LINE_API_DATA_ENDPOINT = os.getenv('LINE_API_DATA_ENDPOINT', 'https://api-data.line.me')
+    # 呼叫 LINE API 的連線池大小、逾時（秒）與暫時性錯誤的重試
+    LINE_API_POOL_SIZE = int(os.getenv('LINE_API_POOL_SIZE', '10'))
+    LINE_API_CONNECT_TIMEOUT = float(os.getenv('LINE_API_CONNECT_TIMEOUT', '3.05'))
+    LINE_API_READ_TIMEOUT = float(os.getenv('LINE_API_READ_TIMEOUT', '10'))
+    LINE_API_CONTENT_TIMEOUT = float(os.getenv('LINE_API_CONTENT_TIMEOUT', '30'))
+    LINE_API_MAX_RETRIES = int(os.getenv('LINE_API_MAX_RETRIES', '2'))
+    LINE_API_BACKOFF_BASE = float(os.getenv('LINE_API_BACKOFF_BASE', '0.2'))
+    LINE_API_BACKOFF_MAX = float(os.getenv('LINE_API_BACKOFF_MAX', '2.0'))
+    LINE_API_RETRY_BUDGET_RATIO = float(os.getenv('LINE_API_RETRY_BUDGET_RATIO', '0.1'))
+    SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', '/tmp/lost_items.db')
+    UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/tmp/uploads')
+
+    # 日誌：LOG_FORMAT=json 時一筆一行 JSON；header / body 依比例抽樣輸出
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+    LOG_HEADERS_SAMPLE_RATE = float(os.getenv('LOG_HEADERS_SAMPLE_RATE', '0'))
+    LOG_BODY_SAMPLE_RATE = float(os.getenv('LOG_BODY_SAMPLE_RATE', '0'))
+
+    # SQLite 連線設定（每個執行緒共用一條連線，WAL 模式）
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+    SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '8192'))
+    SQLITE_STATEMENT_CACHE_SIZE = int(os.getenv('SQLITE_STATEMENT_CACHE_SIZE', '128'))
+
+    # Group commit：把同時間多位使用者的上報寫入合併成一次交易（DB_GROUP_COMMIT=1 開啟）
+    DB_GROUP_COMMIT = os.getenv('DB_GROUP_COMMIT', '0') == '1'
+    DB_GROUP_COMMIT_WINDOW_MS = float(os.getenv('DB_GROUP_COMMIT_WINDOW_MS', '2'))
+    DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv('DB_GROUP_COMMIT_MAX_BATCH', '64'))
+
+    # 使用者狀態快取（設為 0 可關閉）
+    STATE_CACHE_ENABLED = os.getenv('STATE_CACHE_ENABLED', '1') == '1'
+    STATE_CACHE_MAX_ENTRIES = int(os.getenv('STATE_CACHE_MAX_ENTRIES', '10000'))
+    STATE_CACHE_TTL = float(os.getenv('STATE_CACHE_TTL', '300'))
+    STATE_CACHE_NEGATIVE_TTL = float(os.getenv('STATE_CACHE_NEGATIVE_TTL', '60'))
+
+    # Webhook 先回 200 再交給背景 worker 處理（WEBHOOK_ASYNC=1 開啟）
+    WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', '0') == '1'
+    WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+    WEBHOOK_QUEUE_MAX = int(os.getenv('WEBHOOK_QUEUE_MAX', '1000'))
+    WEBHOOK_QUEUE_PERSIST = os.getenv('WEBHOOK_QUEUE_PERSIST', '0') == '1'
+    # 同步模式下，一次 webhook 裡不同使用者的事件同時處理（設為 0 則依序處理）
+    WEBHOOK_BATCH_WORKERS = int(os.getenv('WEBHOOK_BATCH_WORKERS', '8'))
+    # 依 webhookEventId 擋掉 LINE 重送的事件，id 保留多久（秒）與記憶體 LRU 大小
+    WEBHOOK_DEDUP_ENABLED = os.getenv('WEBHOOK_DEDUP_ENABLED', '1') == '1'
+    WEBHOOK_DEDUP_TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', str(24 * 3600)))
+    WEBHOOK_DEDUP_MAX_ENTRIES = int(os.getenv('WEBHOOK_DEDUP_MAX_ENTRIES', '10000'))
+
+    # 上傳圖片：下載分段大小與縮圖尺寸（像素，取長邊）
+    IMAGE_CHUNK_SIZE = int(os.getenv('IMAGE_CHUNK_SIZE', str(64 * 1024)))
+    IMAGE_CAROUSEL_SIZE = int(os.getenv('IMAGE_CAROUSEL_SIZE', '720'))
+
+    # 上傳圖片的靜態傳送：內容雜湊命名的檔案可以永久快取
+    UPLOAD_BASE_URL = os.getenv('UPLOAD_BASE_URL')
+    UPLOAD_CACHE_MAX_AGE = int(os.getenv('UPLOAD_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+    LEGACY_UPLOAD_CACHE_MAX_AGE = int(os.getenv('LEGACY_UPLOAD_CACHE_MAX_AGE', '3600'))
+    UPLOAD_USE_X_SENDFILE = os.getenv('UPLOAD_USE_X_SENDFILE', '0') == '1'
+
+    # 「找遺失物」列表的渲染快取，最多保留幾個分頁
+    RENDER_CACHE_MAX_ENTRIES = int(os.getenv('RENDER_CACHE_MAX_ENTRIES', '64'))
+
+    # 定期清理：沒填完的失物、放著不管的上報流程、沒被引用的上傳檔（秒；預設 0 不啟動，要用時再設定，例如 3600）
+    JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', '0'))
+    JANITOR_ITEM_TTL = float(os.getenv('JANITOR_ITEM_TTL', str(24 * 3600)))
+    JANITOR_STATE_TTL = float(os.getenv('JANITOR_STATE_TTL', str(6 * 3600)))
+    JANITOR_UPLOAD_GRACE = float(os.getenv('JANITOR_UPLOAD_GRACE', '3600'))
+    # 每次 incremental_vacuum 最多回收幾頁（0 = 全部）
+    JANITOR_VACUUM_PAGES = int(os.getenv('JANITOR_VACUUM_PAGES', '0'))
+
+    # /metrics：多個 gunicorn worker 時另外設定 PROMETHEUS_MULTIPROC_DIR（見 gunicorn.conf.py）
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+    # 「附近失物」最遠找多少公尺
+    NEARBY_MAX_RADIUS_M = float(os.getenv('NEARBY_MAX_RADIUS_M', '5000'))
 
     HUGGINGFACE_API_URL = os.getenv('HUGGINGFACE_API_URL')
     HUGGINGFACE_API_TOKEN = os.getenv('HUGGINGFACE_API_TOKEN')
-    
\ No newline at end of file
+    
@@ -1,130 +1,1008 @@
 import sqlite3
+import math
 import os
+import re
+import threading
+import queue
+import time
+import unicodedata
+import uuid
+from concurrent.futures import Future
+from contextlib import contextmanager
 from enum import Enum
-from datetime import datetime 
+from datetime import datetime
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class UserState(Enum):
-    NONE = "none" 
-    REPORTING_START = "reporting_start" 
-    REPORTING_WAIT_IMAGE = "reporting_wait_image" 
-    REPORTING_WAIT_DESCRIPTION = "reporting_wait_description" 
-    REPORTING_WAIT_LOCATION = "reporting_wait_location" 
-    
+    NONE = "none"
+    REPORTING_START = "reporting_start"
+    REPORTING_WAIT_IMAGE = "reporting_wait_image"
+    REPORTING_WAIT_DESCRIPTION = "reporting_wait_description"
+    REPORTING_WAIT_LOCATION = "reporting_wait_location"
+    NEARBY_WAIT_LOCATION = "nearby_wait_location"
+
+# 上報流程中可以隨狀態一起寫入的欄位
+REPORT_FIELDS = ('image_url', 'thumbnail_url', 'description', 'location', 'latitude', 'longitude')
+# 這些欄位變動時要重建該筆失物的全文索引
+SEARCH_FIELDS = ('description', 'location')
+
+# 中日韓文字一段連續的字、或一段英數字，各自當成一個詞；英數字的部分要排除中日韓文字，
+# 否則「iPhone手機」會被當成同一個詞
+_CJK_RANGES = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_SEARCH_WORD_PATTERN = re.compile(f'[{_CJK_RANGES}]+|[^\\W_{_CJK_RANGES}]+')
+_CJK_PATTERN = re.compile(f'[{_CJK_RANGES}]')
+_LATLNG_PATTERN = re.compile(r'^\s*-?\d+(\.\d+)?\s*,\s*-?\d+(\.\d+)?\s*$')
+
+# 資料表結構有變動（新增欄位、索引、資料表）時加 1，啟動時只有版本落後才執行 DDL
+SCHEMA_VERSION = 4
+
+LOST_ITEM_COLUMNS = ('item_id', 'user_id', 'image_url', 'description', 'location', 'report_date', 'thumbnail_url',
+                     'latitude', 'longitude')
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = 111320.0
+
+# 匯出 / 匯入用的欄位：失物的所有欄位加上是否已結案
+EXPORT_FIELDS = LOST_ITEM_COLUMNS + ('is_resolved',)
+# 一次 IN (...) 查詢最多帶幾個參數（SQLite 3.32 之前上限是 999）
+_MAX_IN_PARAMS = 500
+
+def _resolved_filter(resolved, prefix=""):
+    # 寫成常數而不是 ? 參數，查詢規劃器才能確定可以用 WHERE is_resolved = 0 的部分索引
+    return f"{prefix}is_resolved = {1 if resolved else 0}"
+
+def _item_columns(prefix=""):
+    return ", ".join(prefix + column for column in LOST_ITEM_COLUMNS)
+
+def parse_latlng(location):
+    # "lat,lng" 格式的位置字串轉成數值，其他文字回傳 (None, None)
+    if not location or not _LATLNG_PATTERN.match(location):
+        return None, None
+    latitude, longitude = (float(part) for part in location.split(','))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None
+    return latitude, longitude
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def search_index_tokens(text):
+    # FTS5 的 unicode61 會把整段中文當成一個詞，所以先在 Python 切成單字 + 相鄰兩字 (bigram)，以空白分隔
+    if not text:
+        return ""
+    tokens = []
+    for word in _SEARCH_WORD_PATTERN.findall(unicodedata.normalize('NFKC', text).lower()):
+        if _CJK_PATTERN.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return " ".join(tokens)
+
+def search_match_query(keyword):
+    # 查詢時中文只用 bigram（單一個字才用單字），英數字用前綴比對；全部 AND 起來
+    terms = []
+    for word in _SEARCH_WORD_PATTERN.findall(unicodedata.normalize('NFKC', keyword or "").lower()):
+        if _CJK_PATTERN.match(word):
+            if len(word) == 1:
+                terms.append(f'"{word}"')
+            else:
+                terms.extend(f'"{word[i:i + 2]}"' for i in range(len(word) - 1))
+        else:
+            terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+class GroupCommitter:
+    """
+    把同一時間多個使用者的寫入合併成一次交易 (group commit)。
+
+    每個寫入操作各自包在 SAVEPOINT 裡，單一操作失敗只會回滾自己那一段；
+    整批 COMMIT 之後才執行各操作的 after_commit（例如更新狀態快取）並通知呼叫端。
+    """
+
+    def __init__(self, db_manager, window_ms=2, max_batch=64):
+        self.db_manager = db_manager
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, name="db-group-commit", daemon=True).start()
+
+    def submit(self, op):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((op, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        conn = self.db_manager._get_connection()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for index, (op, future) in enumerate(batch):
+                conn.execute(f"SAVEPOINT op_{index}")
+                try:
+                    results.append((future, op(conn), None))
+                    conn.execute(f"RELEASE op_{index}")
+                except Exception as e:
+                    conn.execute(f"ROLLBACK TO op_{index}")
+                    conn.execute(f"RELEASE op_{index}")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.operations += len(batch)
+        for future, after_commit, error in results:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            try:
+                if after_commit:
+                    after_commit()
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "operations": self.operations,
+            "pending": self._queue.qsize(),
+        }
+
 class DBManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, busy_timeout_ms=5000, cache_size_kb=8192, statement_cache_size=128, state_cache=None,
+                 group_commit=False, group_commit_window_ms=2, group_commit_max_batch=64):
         self.db_path = db_path
+        self.state_cache = state_cache
+        self.group_committer = None
+        if group_commit:
+            self.group_committer = GroupCommitter(self, window_ms=group_commit_window_ms, max_batch=group_commit_max_batch)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.statement_cache_size = statement_cache_size
+        # 每個執行緒各自持有一條連線，避免每次查詢都重新 connect / close
+        self._local = threading.local()
+        self.search_enabled = False
+        self.geo_index_enabled = False
         self._ensure_db_dir_exists()
         self._create_tables()
 
     def _ensure_db_dir_exists(self):
         db_dir = os.path.dirname(self.db_path)
-        if not os.path.exists(db_dir):
+        if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
 
     def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+        conn = getattr(self._local, 'conn', None)
+        # gunicorn fork 之後不能沿用父行程的連線，依 pid 判斷是否需要重新建立
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            cached_statements=self.statement_cache_size,
+        )
+        self._configure_connection(conn)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
 
-    def _create_tables(self):
+    def _configure_connection(self, conn):
+        # 要在切換 WAL 之前設定才會對新建立的資料庫生效；舊資料庫由 compact() 第一次執行時轉換
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE 一開始就拿寫入鎖，避免讀鎖升級成寫鎖時互相卡住
         conn = self._get_connection()
-        cursor = conn.cursor()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def schema_version(self):
+        return self._get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+    def _detect_virtual_tables(self, conn):
+        names = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('lost_items_fts', 'lost_items_geo')")}
+        self.search_enabled = 'lost_items_fts' in names
+        self.geo_index_enabled = 'lost_items_geo' in names
 
-        cursor.execute('''
+    def _create_tables(self):
+        # 已經是最新版本就不跑 DDL，啟動時只多一個 PRAGMA 查詢
+        if self.schema_version() >= SCHEMA_VERSION:
+            self._detect_virtual_tables(self._get_connection())
+            return
+        with self._transaction() as conn:
+            # 多個 worker 同時啟動時，拿到寫入鎖之後再確認一次
+            from_version = self.schema_version()
+            if from_version >= SCHEMA_VERSION:
+                self._detect_virtual_tables(conn)
+                return
+            self._migrate(conn)
+            # 版本 3 修正了英數字與中文相連時的斷詞，既有的全文索引要重建
+            if 0 < from_version < 3 and self.search_enabled:
+                self._rebuild_search_index_in_transaction(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        logging.info(f"INFO: Database schema migrated to version {SCHEMA_VERSION}.")
+
+    def _migrate(self, conn):
+        # 以下 DDL 都可以重複執行，舊版本的資料庫會補上缺少的部分
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS user_states (
                 user_id TEXT PRIMARY KEY,
                 state TEXT NOT NULL,
-                current_item_id TEXT 
+                current_item_id TEXT,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL
             )
         ''')
+        self._ensure_column(conn, 'user_states', 'version', 'INTEGER NOT NULL DEFAULT 0')
+        # 狀態快取用 version 找出其他 worker 改過的使用者
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_states_version ON user_states (version)")
+        # 狀態最後一次變動的時間，janitor 用來清掉放著不管的流程
+        if self._ensure_column(conn, 'user_states', 'updated_at', 'REAL'):
+            conn.execute("UPDATE user_states SET updated_at = ?", (time.time(),))
 
-        cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS lost_items (
                 item_id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL, 
+                user_id TEXT NOT NULL,
                 image_url TEXT,
                 description TEXT,
                 location TEXT,
                 report_date TEXT NOT NULL,
-                is_resolved BOOLEAN DEFAULT FALSE 
+                is_resolved BOOLEAN DEFAULT FALSE,
+                thumbnail_url TEXT,
+                latitude REAL,
+                longitude REAL
+            )
+        ''')
+        self._ensure_column(conn, 'lost_items', 'thumbnail_url', 'TEXT')
+        # 位置是經緯度時另外存成數值，地圖按鈕與附近查詢不必再解析字串
+        added_latitude = self._ensure_column(conn, 'lost_items', 'latitude', 'REAL')
+        self._ensure_column(conn, 'lost_items', 'longitude', 'REAL')
+        if added_latitude:
+            self._backfill_coordinates(conn)
+        # 失物列表依 report_date 走索引，item_id 作為同時間的排序依據。
+        # 只包含未結案失物的部分索引：大量結案之後，列表掃的索引仍然只有還在招領中的失物
+        # （取代舊版的 (is_resolved, report_date, item_id) 索引，已結案的失物只有匯出會讀）
+        conn.execute("DROP INDEX IF EXISTS idx_lost_items_resolved_date")
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_lost_items_unresolved_date
+            ON lost_items (report_date, item_id) WHERE is_resolved = 0
+        ''')
+
+        # ack-first 模式下尚未處理完的 webhook 事件
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_key TEXT NOT NULL,
+                body TEXT NOT NULL,
+                url_root TEXT,
+                enqueued_at REAL NOT NULL,
+                owner_pid INTEGER NOT NULL
             )
         ''')
-        conn.commit()
-        conn.close()
+
+        # 已經收過的 webhookEventId，用來擋掉 LINE 重送的事件
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_event_ids (
+                event_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_webhook_event_ids_seen_at
+            ON webhook_event_ids (seen_at)
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS db_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('state_epoch', 0)")
+        conn.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('listing_epoch', 0)")
+
+        self._create_search_index(conn)
+        self._create_geo_index(conn)
+
+    def _create_search_index(self, conn):
+        # 失物描述與位置的全文索引；rowid 對應 lost_items 的 rowid
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lost_items_fts'").fetchone()
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS lost_items_fts
+                USING fts5(description, location, tokenize = 'unicode61 remove_diacritics 2')
+            ''')
+        except sqlite3.OperationalError as e:
+            logging.warning(f"WARNING: SQLite FTS5 is not available ({e}). Lost item search falls back to LIKE.")
+            return
+        self.search_enabled = True
+        if not exists:
+            self._rebuild_search_index_in_transaction(conn)
+
+    def _create_geo_index(self, conn):
+        # R*Tree：id 對應 lost_items 的 rowid，每筆失物是一個點 (min == max)
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lost_items_geo'").fetchone()
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS lost_items_geo
+                USING rtree(id, min_lat, max_lat, min_lng, max_lng)
+            ''')
+        except sqlite3.OperationalError as e:
+            logging.warning(f"WARNING: SQLite R*Tree is not available ({e}). Nearby lookups fall back to a coordinate index.")
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_lost_items_latlng
+                ON lost_items (latitude, longitude)
+            ''')
+            return
+        self.geo_index_enabled = True
+        if not exists:
+            self._rebuild_geo_index_in_transaction(conn)
+
+    def _backfill_coordinates(self, conn):
+        rows = conn.execute("SELECT item_id, location FROM lost_items WHERE location IS NOT NULL").fetchall()
+        updates = [(*parse_latlng(location), item_id) for item_id, location in rows]
+        conn.executemany("UPDATE lost_items SET latitude = ?, longitude = ? WHERE item_id = ?",
+                         [update for update in updates if update[0] is not None])
+
+    def _index_item_geo_in_transaction(self, conn, item_id):
+        if not self.geo_index_enabled:
+            return
+        row = conn.execute("SELECT rowid, latitude, longitude FROM lost_items WHERE item_id = ?", (item_id,)).fetchone()
+        if row is None:
+            return
+        rowid, latitude, longitude = row
+        conn.execute("DELETE FROM lost_items_geo WHERE id = ?", (rowid,))
+        if latitude is not None and longitude is not None:
+            conn.execute("INSERT INTO lost_items_geo (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                         (rowid, latitude, latitude, longitude, longitude))
+
+    def _rebuild_geo_index_in_transaction(self, conn):
+        conn.execute("DELETE FROM lost_items_geo")
+        conn.execute('''
+            INSERT INTO lost_items_geo (id, min_lat, max_lat, min_lng, max_lng)
+            SELECT rowid, latitude, latitude, longitude, longitude FROM lost_items
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ''')
+
+    def rebuild_geo_index(self):
+        # 與全文索引相同，VACUUM 之後要重建
+        if not self.geo_index_enabled:
+            return
+        with self._transaction() as conn:
+            self._rebuild_geo_index_in_transaction(conn)
+
+    def _index_item_in_transaction(self, conn, item_id):
+        if not self.search_enabled:
+            return
+        row = conn.execute("SELECT rowid, description, location FROM lost_items WHERE item_id = ?", (item_id,)).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM lost_items_fts WHERE rowid = ?", (row[0],))
+        conn.execute("INSERT INTO lost_items_fts (rowid, description, location) VALUES (?, ?, ?)",
+                     (row[0], search_index_tokens(row[1]), self._location_tokens(row[2])))
+
+    def _location_tokens(self, location):
+        # 經緯度字串只會讓數字查詢誤中，不放進索引
+        if location and _LATLNG_PATTERN.match(location):
+            return ""
+        return search_index_tokens(location)
+
+    def _rebuild_search_index_in_transaction(self, conn):
+        conn.execute("DELETE FROM lost_items_fts")
+        rows = conn.execute("SELECT rowid, description, location FROM lost_items").fetchall()
+        conn.executemany("INSERT INTO lost_items_fts (rowid, description, location) VALUES (?, ?, ?)",
+                         ((rowid, search_index_tokens(description), self._location_tokens(location))
+                          for rowid, description, location in rows))
+
+    def rebuild_search_index(self):
+        # VACUUM 可能重新編號 rowid，之後要整個重建
+        if not self.search_enabled:
+            return
+        with self._transaction() as conn:
+            self._rebuild_search_index_in_transaction(conn)
+
+    def _ensure_column(self, conn, table, column, definition):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column in columns:
+            return False
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+
+    def _read_meta(self, conn, key):
+        row = conn.execute("SELECT value FROM db_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_meta(self, conn, key):
+        # 必須在交易內呼叫，回傳 (舊值, 新值)
+        old_value = self._read_meta(conn, key)
+        conn.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES (?, ?)", (key, old_value + 1))
+        return old_value, old_value + 1
+
+    def _sync_state_cache(self):
+        # PRAGMA data_version 只有在其他連線 commit 之後才會變，沒變就不用碰資料表
+        conn = self._get_connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == getattr(self._local, 'data_version', None):
+            return
+        self._local.data_version = data_version
+        cached_epoch = self.state_cache.epoch
+        epoch = self._read_meta(conn, 'state_epoch')
+        if cached_epoch is None or epoch <= cached_epoch:
+            self.state_cache.sync_epoch(epoch)
+            return
+        # 只讓這段期間被改過的使用者失效；先讀 epoch 再查，查到的只會多不會少
+        changes = conn.execute("SELECT user_id, version FROM user_states WHERE version > ?", (cached_epoch,)).fetchall()
+        self.state_cache.sync_epoch(epoch, changes)
+
+    def _write_through_state(self, user_id, state, current_item_id, old_epoch, new_epoch):
+        if self.state_cache is None:
+            return
+        self.state_cache.advance_epoch(old_epoch, new_epoch)
+        self.state_cache.put(user_id, state, current_item_id, new_epoch, negative=state is UserState.NONE)
 
     def get_user_state(self, user_id):
+        if self.state_cache is not None:
+            self._sync_state_cache()
+            epoch = self.state_cache.epoch
+            cached = self.state_cache.get(user_id)
+            if cached is not None:
+                return cached
+
         conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT state, current_item_id FROM user_states WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = conn.execute("SELECT state, current_item_id FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
         if result:
-            return UserState(result[0]), result[1]
-        return UserState.NONE, None 
+            state, current_item_id = UserState(result[0]), result[1]
+        else:
+            state, current_item_id = UserState.NONE, None
+
+        if self.state_cache is not None and epoch is not None:
+            self.state_cache.put(user_id, state, current_item_id, epoch, negative=state is UserState.NONE)
+        return state, current_item_id
 
     def update_user_state(self, user_id, new_state, current_item_id=None):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO user_states (user_id, state, current_item_id) VALUES (?, ?, ?)",
-                       (user_id, new_state.value, current_item_id))
-        conn.commit()
-        conn.close()
+        self._write(lambda conn: self._set_state_in_transaction(conn, user_id, new_state, current_item_id))
 
     def clear_user_state(self, user_id):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        self._write(lambda conn: self._set_state_in_transaction(conn, user_id, UserState.NONE, None))
+
+    def _write(self, op):
+        # op(conn) 在交易內執行，回傳 commit 之後要做的事（或 None）
+        if self.group_committer is not None:
+            return self.group_committer.submit(op)
+        with self._transaction() as conn:
+            after_commit = op(conn)
+        if after_commit:
+            after_commit()
+
+    def _set_state_in_transaction(self, conn, user_id, new_state, current_item_id):
+        old_epoch, new_epoch = self._bump_meta(conn, 'state_epoch')
+        if new_state is UserState.NONE:
+            # 清除狀態時留下一筆 NONE 的紀錄（不直接刪除），其他 worker 才看得到它的 version
+            current_item_id = None
+        conn.execute("INSERT OR REPLACE INTO user_states (user_id, state, current_item_id, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+                     (user_id, new_state.value, current_item_id, new_epoch, time.time()))
+        return lambda: self._write_through_state(user_id, new_state, current_item_id, old_epoch, new_epoch)
+
+    def start_report(self, user_id, next_state):
+        # 新增失物並把使用者切到下一個狀態，一次交易完成
+        item_id = str(uuid.uuid4())
+        report_date = datetime.now().isoformat()
+
+        def op(conn):
+            conn.execute("INSERT INTO lost_items (item_id, user_id, report_date) VALUES (?, ?, ?)",
+                         (item_id, user_id, report_date))
+            return self._set_state_in_transaction(conn, user_id, next_state, item_id)
+
+        self._write(op)
+        return item_id
+
+    def advance_report(self, user_id, item_id, fields, next_state):
+        # 「更新失物欄位 + 切換使用者狀態」在同一個交易裡完成，不會只寫了一半
+        unknown = set(fields) - set(REPORT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown lost item fields: {sorted(unknown)}")
+        if 'location' in fields and 'latitude' not in fields:
+            # 文字輸入的位置若剛好是經緯度，也一併存成數值
+            latitude, longitude = parse_latlng(fields['location'])
+            fields = {**fields, 'latitude': latitude, 'longitude': longitude}
+
+        def op(conn):
+            assignments = ", ".join(f"{column} = ?" for column in fields)
+            conn.execute(f"UPDATE lost_items SET {assignments} WHERE item_id = ?", (*fields.values(), item_id))
+            if any(field in SEARCH_FIELDS for field in fields):
+                self._index_item_in_transaction(conn, item_id)
+            if 'latitude' in fields or 'longitude' in fields:
+                self._index_item_geo_in_transaction(conn, item_id)
+            if 'location' in fields:
+                self._bump_meta(conn, 'listing_epoch')
+            return self._set_state_in_transaction(conn, user_id, next_state, item_id)
+
+        self._write(op)
 
     def create_new_lost_item(self, user_id):
-        import uuid
         item_id = str(uuid.uuid4())
         report_date = datetime.now().isoformat()
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO lost_items (item_id, user_id, report_date) VALUES (?, ?, ?)",
-                       (item_id, user_id, report_date))
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO lost_items (item_id, user_id, report_date) VALUES (?, ?, ?)",
+                         (item_id, user_id, report_date))
         return item_id
 
-    def save_item_image_url(self, item_id, image_url): 
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE lost_items SET image_url = ? WHERE item_id = ?", (image_url, item_id))
-        conn.commit()
-        conn.close()
+    def save_item_image_url(self, item_id, image_url, thumbnail_url=None):
+        with self._transaction() as conn:
+            conn.execute("UPDATE lost_items SET image_url = ?, thumbnail_url = ? WHERE item_id = ?", (image_url, thumbnail_url, item_id))
 
     def save_item_description(self, item_id, description):
+        with self._transaction() as conn:
+            conn.execute("UPDATE lost_items SET description = ? WHERE item_id = ?", (description, item_id))
+            self._index_item_in_transaction(conn, item_id)
+
+    def save_item_location(self, item_id, location, latitude=None, longitude=None):
+        # 填完位置代表上報完成，失物列表需要重新渲染
+        if latitude is None or longitude is None:
+            latitude, longitude = parse_latlng(location)
+        with self._transaction() as conn:
+            conn.execute("UPDATE lost_items SET location = ?, latitude = ?, longitude = ? WHERE item_id = ?",
+                         (location, latitude, longitude, item_id))
+            self._index_item_in_transaction(conn, item_id)
+            self._index_item_geo_in_transaction(conn, item_id)
+            self._bump_meta(conn, 'listing_epoch')
+
+    def resolve_lost_item(self, item_id, resolved=True):
+        with self._transaction() as conn:
+            conn.execute("UPDATE lost_items SET is_resolved = ? WHERE item_id = ?", (resolved, item_id))
+            self._bump_meta(conn, 'listing_epoch')
+
+    def get_listing_epoch(self):
+        return self._read_meta(self._get_connection(), 'listing_epoch')
+
+    def _row_to_item(self, row):
+        return {
+            "item_id": row[0],
+            "user_id": row[1],
+            "image_url": row[2],
+            "description": row[3],
+            "location": row[4],
+            "report_date": row[5],
+            "thumbnail_url": row[6],
+            "latitude": row[7],
+            "longitude": row[8]
+        }
+
+    def retrieve_lost_items(self, resolved=False):
         conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE lost_items SET description = ? WHERE item_id = ?", (description, item_id))
-        conn.commit()
-        conn.close()
+        cursor = conn.execute(f"SELECT {_item_columns()} FROM lost_items WHERE {_resolved_filter(resolved)} ORDER BY report_date DESC, item_id DESC")
+        return [self._row_to_item(row) for row in cursor.fetchall()]
 
-    def save_item_location(self, item_id, location):
+    def retrieve_lost_items_page(self, resolved=False, limit=10, before=None):
+        # Keyset 分頁：before 為上一頁最後一筆的 (report_date, item_id)
+        # 回傳 (items, next_cursor)，沒有下一頁時 next_cursor 為 None
         conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE lost_items SET location = ? WHERE item_id = ?", (location, item_id))
-        conn.commit()
-        conn.close()
+        if before:
+            cursor = conn.execute(
+                f"SELECT {_item_columns()} FROM lost_items "
+                f"WHERE {_resolved_filter(resolved)} AND (report_date, item_id) < (?, ?) "
+                "ORDER BY report_date DESC, item_id DESC LIMIT ?",
+                (before[0], before[1], limit + 1))
+        else:
+            cursor = conn.execute(
+                f"SELECT {_item_columns()} FROM lost_items "
+                f"WHERE {_resolved_filter(resolved)} ORDER BY report_date DESC, item_id DESC LIMIT ?",
+                (limit + 1,))
+        items = [self._row_to_item(row) for row in cursor.fetchall()]
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = (items[-1]["report_date"], items[-1]["item_id"])
+        return items, next_cursor
 
-    def retrieve_lost_items(self, resolved=False):
+    def search_lost_items(self, keyword, resolved=False, limit=10, offset=0):
+        # 依相關度 (bm25，描述的權重比位置高) 排序，回傳 (items, next_offset)
         conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT item_id, user_id, image_url, description, location, report_date FROM lost_items WHERE is_resolved = ? ORDER BY report_date DESC", (resolved,))
-        items = []
-        for row in cursor.fetchall():
-            items.append({
-                "item_id": row[0],
-                "user_id": row[1],
-                "image_url": row[2],
-                "description": row[3],
-                "location": row[4],
-                "report_date": row[5]
-            })
-        conn.close()
-        return items
-    
\ No newline at end of file
+        if self.search_enabled:
+            match_query = search_match_query(keyword)
+            if not match_query:
+                return [], None
+            cursor = conn.execute(
+                f"SELECT {_item_columns('li.')} "
+                "FROM lost_items_fts JOIN lost_items li ON li.rowid = lost_items_fts.rowid "
+                f"WHERE lost_items_fts MATCH ? AND {_resolved_filter(resolved, 'li.')} "
+                "ORDER BY bm25(lost_items_fts, 2.0, 1.0), li.report_date DESC LIMIT ? OFFSET ?",
+                (match_query, limit + 1, offset))
+        else:
+            keyword = (keyword or "").strip()
+            if not keyword:
+                return [], None
+            pattern = "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            cursor = conn.execute(
+                f"SELECT {_item_columns()} FROM lost_items "
+                f"WHERE {_resolved_filter(resolved)} AND (description LIKE ? ESCAPE '\\' OR location LIKE ? ESCAPE '\\') "
+                "ORDER BY report_date DESC, item_id DESC LIMIT ? OFFSET ?",
+                (pattern, pattern, limit + 1, offset))
+        items = [self._row_to_item(row) for row in cursor.fetchall()]
+        next_offset = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_offset = offset + limit
+        return items, next_offset
+
+    def find_lost_items_near(self, latitude, longitude, limit=10, max_radius_m=5000, resolved=False):
+        # 先用外接矩形在 R*Tree 裡篩選，再以實際距離排序；半徑由小往大擴，湊滿 limit 筆就停
+        # 回傳的每筆失物多一個 distance_m 欄位
+        conn = self._get_connection()
+        radius = min(250.0, max_radius_m)
+        while True:
+            d_lat = radius / METERS_PER_DEGREE_LAT
+            d_lng = radius / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 0.01))
+            box = (latitude - d_lat, latitude + d_lat, longitude - d_lng, longitude + d_lng)
+            if self.geo_index_enabled:
+                cursor = conn.execute(
+                    f"SELECT {_item_columns('li.')} FROM lost_items_geo g JOIN lost_items li ON li.rowid = g.id "
+                    f"WHERE g.max_lat >= ? AND g.min_lat <= ? AND g.max_lng >= ? AND g.min_lng <= ? AND {_resolved_filter(resolved, 'li.')}",
+                    box)
+            else:
+                cursor = conn.execute(
+                    f"SELECT {_item_columns()} FROM lost_items "
+                    f"WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ? AND {_resolved_filter(resolved)}",
+                    box)
+            nearby = []
+            for row in cursor.fetchall():
+                item = self._row_to_item(row)
+                item["distance_m"] = haversine_m(latitude, longitude, item["latitude"], item["longitude"])
+                if item["distance_m"] <= radius:
+                    nearby.append(item)
+            if len(nearby) >= limit or radius >= max_radius_m:
+                nearby.sort(key=lambda item: (item["distance_m"], item["report_date"]))
+                return nearby[:limit]
+            radius = min(radius * 2, max_radius_m)
+
+    def expire_stale_user_states(self, older_than, dry_run=False):
+        # 把 updated_at 早於 older_than 的狀態清成 NONE，回傳 [(user_id, state, current_item_id), ...]
+        # 同樣早於 older_than 的 NONE 紀錄直接刪掉；這麼久以前的變動，各 worker 的快取早就過期了
+        select_stale = "SELECT user_id, state, current_item_id FROM user_states WHERE updated_at < ? AND state != ?"
+        if dry_run:
+            return self._get_connection().execute(select_stale, (older_than, UserState.NONE.value)).fetchall()
+        expired = []
+
+        def op(conn):
+            # 在同一個寫入交易裡查出要清掉的列，只更新這些列，回傳與快取失效的也正好是這些使用者
+            rows = conn.execute(select_stale, (older_than, UserState.NONE.value)).fetchall()
+            expired[:] = rows
+            conn.execute("DELETE FROM user_states WHERE updated_at < ? AND state = ?", (older_than, UserState.NONE.value))
+            if not rows:
+                return None
+            old_epoch, new_epoch = self._bump_meta(conn, 'state_epoch')
+            now = time.time()
+            conn.executemany("UPDATE user_states SET state = ?, current_item_id = NULL, version = ?, updated_at = ? WHERE user_id = ?",
+                             [(UserState.NONE.value, new_epoch, now, user_id) for user_id, _, _ in rows])
+
+            def after_commit():
+                if self.state_cache is not None:
+                    self.state_cache.advance_epoch(old_epoch, new_epoch)
+                    for user_id, _, _ in rows:
+                        self.state_cache.invalidate(user_id)
+            return after_commit
+
+        self._write(op)
+        return expired
+
+    def find_abandoned_lost_items(self, reported_before, live_states_after=0):
+        # 沒填完位置、也沒有使用者還在上報流程中（狀態在 live_states_after 之後更新過）的失物
+        conn = self._get_connection()
+        return conn.execute('''
+            SELECT item_id, report_date FROM lost_items li
+            WHERE location IS NULL AND is_resolved = 0 AND report_date < ?
+            AND NOT EXISTS (
+                SELECT 1 FROM user_states us
+                WHERE us.current_item_id = li.item_id AND us.updated_at >= ?
+            )
+        ''', (reported_before, live_states_after)).fetchall()
+
+    def delete_lost_items(self, item_ids, incomplete_only=False):
+        # 連同全文索引與 R*Tree 一起刪除，回傳實際刪掉的 item_id
+        deleted = []
+        with self._transaction() as conn:
+            for item_id in item_ids:
+                sql = "SELECT rowid FROM lost_items WHERE item_id = ?"
+                if incomplete_only:
+                    sql += " AND location IS NULL"
+                row = conn.execute(sql, (item_id,)).fetchone()
+                if row is None:
+                    continue
+                if self.search_enabled:
+                    conn.execute("DELETE FROM lost_items_fts WHERE rowid = ?", (row[0],))
+                if self.geo_index_enabled:
+                    conn.execute("DELETE FROM lost_items_geo WHERE id = ?", (row[0],))
+                conn.execute("DELETE FROM lost_items WHERE rowid = ?", (row[0],))
+                deleted.append(item_id)
+            if deleted:
+                self._bump_meta(conn, 'listing_epoch')
+        return deleted
+
+    def _index_items_in_transaction(self, conn, item_ids):
+        # 批次版的 _index_item_in_transaction / _index_item_geo_in_transaction
+        if not self.search_enabled and not self.geo_index_enabled:
+            return
+        item_ids = list(item_ids)
+        for start in range(0, len(item_ids), _MAX_IN_PARAMS):
+            chunk = item_ids[start:start + _MAX_IN_PARAMS]
+            rows = conn.execute(
+                f"SELECT rowid, description, location, latitude, longitude FROM lost_items "
+                f"WHERE item_id IN ({', '.join('?' for _ in chunk)})", chunk).fetchall()
+            rowids = [(row[0],) for row in rows]
+            if self.search_enabled:
+                conn.executemany("DELETE FROM lost_items_fts WHERE rowid = ?", rowids)
+                conn.executemany("INSERT INTO lost_items_fts (rowid, description, location) VALUES (?, ?, ?)",
+                                 ((rowid, search_index_tokens(description), self._location_tokens(location))
+                                  for rowid, description, location, _, _ in rows))
+            if self.geo_index_enabled:
+                conn.executemany("DELETE FROM lost_items_geo WHERE id = ?", rowids)
+                conn.executemany("INSERT INTO lost_items_geo (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                                 ((rowid, latitude, latitude, longitude, longitude)
+                                  for rowid, _, _, latitude, longitude in rows
+                                  if latitude is not None and longitude is not None))
+
+    def _report_date_range(self, reported_after=None, reported_before=None):
+        # after <= report_date < before；report_date 是 ISO 字串，可以直接比較
+        clauses, params = [], []
+        if reported_after is not None:
+            clauses.append("report_date >= ?")
+            params.append(reported_after)
+        if reported_before is not None:
+            clauses.append("report_date < ?")
+            params.append(reported_before)
+        return clauses, params
+
+    def iter_lost_items(self, resolved=None, reported_after=None, reported_before=None, batch_size=500):
+        # 依寫入順序 (rowid) 逐批 fetchmany，不需要排序，整個資料表不會一次讀進記憶體
+        # 產生的 dict 除了 _row_to_item 的欄位之外多一個 is_resolved；resolved=None 表示全部
+        clauses, params = self._report_date_range(reported_after, reported_before)
+        if resolved is not None:
+            clauses.append(_resolved_filter(resolved))
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        cursor = self._get_connection().execute(
+            f"SELECT {_item_columns()}, is_resolved FROM lost_items {where}ORDER BY rowid", params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    item = self._row_to_item(row)
+                    item["is_resolved"] = bool(row[len(LOST_ITEM_COLUMNS)])
+                    yield item
+        finally:
+            cursor.close()
+
+    def _import_row(self, item, user_id):
+        unknown = set(item) - set(EXPORT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown lost item fields: {sorted(unknown)}")
+        row = {field: item.get(field) for field in EXPORT_FIELDS}
+        row['item_id'] = row['item_id'] or str(uuid.uuid4())
+        row['user_id'] = row['user_id'] or user_id
+        row['report_date'] = row['report_date'] or datetime.now().isoformat()
+        if row['latitude'] is None and row['location']:
+            row['latitude'], row['longitude'] = parse_latlng(row['location'])
+        row['is_resolved'] = 1 if row['is_resolved'] else 0
+        return tuple(row[field] for field in EXPORT_FIELDS)
+
+    def import_lost_items(self, items, user_id='import', replace=False, batch_size=500):
+        # items 為 dict 的 iterable，每 batch_size 筆以 executemany 寫入並在同一個交易裡更新索引
+        # item_id 已存在時略過，replace=True 則覆寫（保留 rowid，索引對得上）
+        # 回傳 (寫入筆數, 略過筆數)
+        imported = skipped = 0
+        batch = []
+        for item in items:
+            batch.append(self._import_row(item, user_id))
+            if len(batch) >= batch_size:
+                written = self._import_batch(batch, replace)
+                imported, skipped = imported + written, skipped + len(batch) - written
+                batch = []
+        if batch:
+            written = self._import_batch(batch, replace)
+            imported, skipped = imported + written, skipped + len(batch) - written
+        return imported, skipped
+
+    def _import_batch(self, rows, replace):
+        columns = ", ".join(EXPORT_FIELDS)
+        sql = f"INSERT INTO lost_items ({columns}) VALUES ({', '.join('?' for _ in EXPORT_FIELDS)})"
+        if replace:
+            updates = ", ".join(f"{column} = excluded.{column}" for column in EXPORT_FIELDS if column != 'item_id')
+            sql += f" ON CONFLICT(item_id) DO UPDATE SET {updates}"
+        else:
+            sql += " ON CONFLICT(item_id) DO NOTHING"
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(sql, rows)
+            written = conn.total_changes - before
+            if written:
+                self._index_items_in_transaction(conn, dict.fromkeys(row[0] for row in rows))
+                self._bump_meta(conn, 'listing_epoch')
+        return written
+
+    def resolve_lost_items(self, item_ids=None, reported_after=None, reported_before=None, resolved=True):
+        # 依 item_id 清單及（或）report_date 範圍批次結案，一個交易完成；回傳實際變更的筆數
+        clauses, params = self._report_date_range(reported_after, reported_before)
+        if item_ids is None and not clauses:
+            raise ValueError("resolve_lost_items needs item_ids or a report date range")
+        value = 1 if resolved else 0
+        sql = f"UPDATE lost_items SET is_resolved = {value} WHERE NOT {_resolved_filter(resolved)}"
+        if clauses:
+            sql += " AND " + " AND ".join(clauses)
+        with self._transaction() as conn:
+            before = conn.total_changes
+            if item_ids is None:
+                conn.execute(sql, params)
+            else:
+                conn.executemany(sql + " AND item_id = ?", ((*params, item_id) for item_id in item_ids))
+            changed = conn.total_changes - before
+            if changed:
+                self._bump_meta(conn, 'listing_epoch')
+        return changed
+
+    def iter_item_uploads(self):
+        # 產生 (item_id, image_url, thumbnail_url)，用來找出沒有被引用的上傳檔
+        conn = self._get_connection()
+        yield from conn.execute("SELECT item_id, image_url, thumbnail_url FROM lost_items")
+
+    def is_upload_referenced(self, token):
+        # 刪除上傳檔前的最後確認：有任何失物的圖片網址包含這個檔名（或內容雜湊）就還在使用中
+        conn = self._get_connection()
+        return conn.execute(
+            "SELECT 1 FROM lost_items WHERE instr(image_url, ?) > 0 OR instr(thumbnail_url, ?) > 0 LIMIT 1",
+            (token, token)).fetchone() is not None
+
+    def database_size(self):
+        conn = self._get_connection()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "page_size": page_size,
+            "page_count": conn.execute("PRAGMA page_count").fetchone()[0],
+            "freelist_count": conn.execute("PRAGMA freelist_count").fetchone()[0],
+            "auto_vacuum": conn.execute("PRAGMA auto_vacuum").fetchone()[0],
+        }
+
+    def compact(self, vacuum_pages=0, analyze=True):
+        # 回收空頁、合併 FTS 區段、更新統計資訊；不能在交易中執行
+        conn = self._get_connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # 舊資料庫要完整 VACUUM 一次才能切成 incremental；VACUUM 可能重新編號 rowid，索引要重建
+            logging.info("INFO: Converting database to auto_vacuum=INCREMENTAL with a full VACUUM.")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            self.rebuild_search_index()
+            self.rebuild_geo_index()
+        else:
+            conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+        if self.search_enabled:
+            with self._transaction() as conn:
+                conn.execute("INSERT INTO lost_items_fts (lost_items_fts) VALUES ('optimize')")
+        if analyze:
+            conn.execute("PRAGMA analysis_limit=1000")
+            conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def try_acquire_lease(self, key, now, interval):
+        # 多個 worker 行程時只讓其中一個執行週期性工作
+        with self._transaction() as conn:
+            last_run = self._read_meta(conn, key)
+            if now - last_run < interval:
+                return False
+            conn.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES (?, ?)", (key, int(now)))
+            return True
+
+    def enqueue_webhook_event(self, user_key, body, url_root, enqueued_at, owner_pid):
+        with self._transaction() as conn:
+            cursor = conn.execute("INSERT INTO webhook_queue (user_key, body, url_root, enqueued_at, owner_pid) VALUES (?, ?, ?, ?, ?)",
+                                  (user_key, body, url_root, enqueued_at, owner_pid))
+            return cursor.lastrowid
+
+    def finish_webhook_event(self, row_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM webhook_queue WHERE id = ?", (row_id,))
+
+    def claim_webhook_events(self, event_ids, seen_at, expired_before, prune_before=None):
+        # 登記事件 id，回傳 (這次新登記的 id 集合, 清掉的過期筆數)；
+        # 已存在但早於 expired_before 的視為過期，重新登記
+        result = {"claimed": set(), "pruned": 0}
+
+        def op(conn):
+            if prune_before is not None:
+                result["pruned"] = conn.execute("DELETE FROM webhook_event_ids WHERE seen_at < ?", (prune_before,)).rowcount
+            for event_id in event_ids:
+                cursor = conn.execute(
+                    "INSERT INTO webhook_event_ids (event_id, seen_at) VALUES (?, ?) "
+                    "ON CONFLICT(event_id) DO UPDATE SET seen_at = excluded.seen_at WHERE webhook_event_ids.seen_at < ?",
+                    (event_id, seen_at, expired_before))
+                if cursor.rowcount > 0:
+                    result["claimed"].add(event_id)
+
+        self._write(op)
+        return result["claimed"], result["pruned"]
+
+    def release_webhook_events(self, event_ids):
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM webhook_event_ids WHERE event_id = ?", [(event_id,) for event_id in event_ids])
+
+    def claim_orphaned_webhook_events(self, owner_pid):
+        # 原本負責的 worker 已經不在了（行程不存在），就把它的事件接過來
+        conn = self._get_connection()
+        owners = [row[0] for row in conn.execute("SELECT DISTINCT owner_pid FROM webhook_queue")]
+        dead_owners = [pid for pid in owners if pid == owner_pid or not _pid_alive(pid)]
+        if not dead_owners:
+            return []
+        with self._transaction() as conn:
+            for pid in dead_owners:
+                conn.execute("UPDATE webhook_queue SET owner_pid = ? WHERE owner_pid = ?", (owner_pid, pid))
+            return conn.execute("SELECT id, user_key, body, url_root, enqueued_at FROM webhook_queue WHERE owner_pid = ? ORDER BY id",
+                                (owner_pid,)).fetchall()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
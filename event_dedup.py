@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class EventDeduplicator:
+    """
+    依 webhookEventId 過濾 LINE 重送 (redelivery) 的事件。
+
+    每個事件 id 都記進 SQLite（保留 ttl 秒，跨 gunicorn worker 共用），
+    前面再放一層記憶體 LRU：同一個 worker 最近處理過的 id 不必查資料庫。
+    只有 deliveryContext.isRedelivery 為 true 的事件會先查 LRU；
+    第一次送達的事件直接在資料庫登記，一次 webhook 只有一次寫入。
+    """
+
+    def __init__(self, store, ttl=86400, max_entries=10000, prune_interval=600):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self.checked = 0
+        self.redeliveries = 0
+        self.duplicates = 0
+        self.memory_hits = 0
+        self.released = 0
+        self.pruned = 0
+        self.store_errors = 0
+
+    def filter_events(self, events):
+        """回傳 (要處理的事件, 這次登記的 event id)；重複的事件直接丟掉。"""
+        now = time.time()
+        fresh = []
+        candidates = []
+        with self._lock:
+            for event in events:
+                event_id = event.get('webhookEventId')
+                self.checked += 1
+                if not event_id:
+                    fresh.append(event)
+                    continue
+                redelivery = bool((event.get('deliveryContext') or {}).get('isRedelivery'))
+                if redelivery:
+                    self.redeliveries += 1
+                    expires_at = self._recent.get(event_id)
+                    if expires_at is not None and expires_at > now:
+                        self.memory_hits += 1
+                        self.duplicates += 1
+                        continue
+                candidates.append(event)
+
+        if not candidates:
+            return fresh, []
+
+        event_ids = [event['webhookEventId'] for event in candidates]
+        prune_before = None
+        if now - self._last_prune >= self.prune_interval:
+            self._last_prune = now
+            prune_before = now - self.ttl
+        try:
+            claimed, pruned = self.store.claim_webhook_events(event_ids, now, now - self.ttl, prune_before)
+        except Exception as e:
+            # 資料庫出問題時寧可重複處理，也不要把事件丟掉
+            logging.error(f"ERROR: Failed to record webhook event ids: {e}", exc_info=True)
+            with self._lock:
+                self.store_errors += 1
+            return fresh + candidates, []
+
+        with self._lock:
+            self.pruned += pruned
+            for event in candidates:
+                event_id = event['webhookEventId']
+                self._remember(event_id, now + self.ttl)
+                if event_id in claimed:
+                    fresh.append(event)
+                else:
+                    self.duplicates += 1
+        # 保持原本的事件順序
+        order = {id(event): index for index, event in enumerate(events)}
+        fresh.sort(key=lambda event: order[id(event)])
+        return fresh, [event_id for event_id in event_ids if event_id in claimed]
+
+    def release(self, event_ids):
+        # 處理失敗（回 500）的事件要取消登記，LINE 重送時才會再處理一次
+        if not event_ids:
+            return
+        with self._lock:
+            for event_id in event_ids:
+                self._recent.pop(event_id, None)
+            self.released += len(event_ids)
+        try:
+            self.store.release_webhook_events(event_ids)
+        except Exception as e:
+            logging.error(f"ERROR: Failed to release webhook event ids: {e}", exc_info=True)
+            with self._lock:
+                self.store_errors += 1
+
+    def _remember(self, event_id, expires_at):
+        self._recent[event_id] = expires_at
+        self._recent.move_to_end(event_id)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._recent),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "checked": self.checked,
+                "redeliveries": self.redeliveries,
+                "duplicates": self.duplicates,
+                "memory_hits": self.memory_hits,
+                "released": self.released,
+                "pruned": self.pruned,
+                "store_errors": self.store_errors,
+            }
@@ -0,0 +1,287 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+WebhookJob = namedtuple("WebhookJob", ["row_id", "user_key", "body", "url_root", "enqueued_at"])
+
+
+def sign_webhook_body(channel_secret, body):
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def event_user_key(event):
+    source = event.get('source') or {}
+    return source.get('userId') or source.get('groupId') or source.get('roomId') or ''
+
+
+class QueueFullError(Exception):
+    """EventDispatcher 的佇列一直滿著；pending_event_ids 是這次沒有排進佇列的事件 id。"""
+
+    def __init__(self, user_key, pending_event_ids):
+        super().__init__(f"Webhook queue is full for {user_key}")
+        self.user_key = user_key
+        self.pending_event_ids = pending_event_ids
+
+
+class BatchDispatchError(Exception):
+    """BatchDispatcher 有事件處理失敗；failed_event_ids 是失敗以及因此沒有處理到的事件 id。"""
+
+    def __init__(self, cause, failed_event_ids):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.failed_event_ids = failed_event_ids
+
+
+def body_event_id(body):
+    # split_webhook_body 產生的 body 只有一個事件
+    events = json.loads(body).get('events') or [{}]
+    return events[0].get('webhookEventId')
+
+
+def group_events_by_user(json_body):
+    # 依 user_key 分組，組內保持原本的事件順序；回傳 [(user_key, [body, ...]), ...]
+    groups = OrderedDict()
+    for event, body in split_webhook_body(json_body):
+        groups.setdefault(event_user_key(event), []).append(body)
+    return list(groups.items())
+
+
+def split_webhook_body(json_body):
+    # 把一次 webhook 拆成「一個事件一份 body」，之後可以各自排隊、各自處理
+    destination = json_body.get('destination')
+    for event in json_body.get('events') or []:
+        body = json.dumps({"destination": destination, "events": [event]}, ensure_ascii=False)
+        yield event, body
+
+
+class EventDispatcher:
+    """
+    先回 200 再處理的背景事件佇列。
+
+    每個 worker 執行緒有自己的佇列，事件依 user_id 雜湊分配到固定的 worker，
+    所以同一個使用者的事件一定照順序處理，不同使用者之間則可以並行。
+    store 為 DBManager 時會把事件先寫進 SQLite，行程掛掉之後由其他 worker 接手。
+    """
+
+    def __init__(self, process_func, workers=4, max_queue=1000, store=None, put_timeout=2.0):
+        self.process_func = process_func
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.store = store
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+
+    def start(self):
+        # gunicorn 是先 import 再 fork，所以執行緒要在 worker 行程裡才建立
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            per_worker = max(1, self.max_queue // self.workers)
+            self._queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+            self._threads = []
+            for index, worker_queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(worker_queue,), name=f"webhook-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._recover_orphans()
+
+    def _recover_orphans(self):
+        if self.store is None:
+            return
+        for row_id, user_key, body, url_root, enqueued_at in self.store.claim_orphaned_webhook_events(os.getpid()):
+            logging.info(f"INFO: Recovered queued webhook event {row_id} from a dead worker.")
+            self._put(WebhookJob(row_id, user_key, body, url_root, enqueued_at))
+
+    def submit(self, json_body, url_root):
+        """
+        把一次 webhook 的事件排進佇列，回傳排入的事件數量。
+        佇列等了 put_timeout 秒還是滿的就丟出 QueueFullError，由呼叫端回 503 讓 LINE 重送；
+        不在 request 執行緒直接處理，否則會跑在同一個使用者還在排隊的事件前面。
+        """
+        self.start()
+        count = 0
+        events = list(split_webhook_body(json_body))
+        for index, (event, body) in enumerate(events):
+            user_key = event_user_key(event)
+            enqueued_at = time.time()
+            row_id = None
+            if self.store is not None:
+                row_id = self.store.enqueue_webhook_event(user_key, body, url_root, enqueued_at, os.getpid())
+            job = WebhookJob(row_id, user_key, body, url_root, enqueued_at)
+            if not self._put(job, timeout=self.put_timeout):
+                # 這個事件與後面的事件都不排進佇列（後面的事件不能跑在它前面），交給 LINE 重送
+                if row_id is not None:
+                    self.store.finish_webhook_event(row_id)
+                with self._lock:
+                    self.rejected += len(events) - index
+                logging.warning(f"WARNING: Webhook queue is full for {user_key}, rejecting {len(events) - index} event(s) for redelivery.")
+                raise QueueFullError(user_key, [event.get('webhookEventId') for event, _ in events[index:]
+                                                if event.get('webhookEventId')])
+            count += 1
+        return count
+
+    def _put(self, job, timeout=None):
+        worker_queue = self._queues[hash(job.user_key) % len(self._queues)]
+        try:
+            worker_queue.put(job, timeout=timeout)
+        except queue.Full:
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            job = worker_queue.get()
+            try:
+                self._process(job)
+            finally:
+                worker_queue.task_done()
+
+    def _process(self, job):
+        lag = max(0.0, time.time() - job.enqueued_at)
+        with self._lock:
+            self.in_flight += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._total_lag += lag
+        ok = False
+        try:
+            self.process_func(job)
+            ok = True
+        except Exception as e:
+            logging.error(f"ERROR: Failed to process queued webhook event for {job.user_key}: {e}", exc_info=True)
+        finally:
+            if self.store is not None and job.row_id is not None:
+                try:
+                    self.store.finish_webhook_event(job.row_id)
+                except Exception as e:
+                    logging.error(f"ERROR: Failed to remove queued webhook event {job.row_id}: {e}", exc_info=True)
+            with self._lock:
+                self.in_flight -= 1
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        with self._lock:
+            finished = self.processed + self.failed
+            return {
+                "workers": self.workers,
+                "depth": self.depth(),
+                "in_flight": self.in_flight,
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+                "avg_lag_seconds": self._total_lag / finished if finished else 0.0,
+            }
+
+
+class BatchDispatcher:
+    """
+    同步模式下，把一次 webhook 裡不同使用者的事件分給執行緒池同時處理。
+
+    同一個使用者的事件在同一個工作裡依序處理，另外用分段鎖 (striped lock)
+    讓同一個使用者在不同 request 之間也不會同時處理，UserState 不會被交錯改寫。
+    整批的耗時取決於最慢的那位使用者，而不是所有使用者的總和。
+    """
+
+    def __init__(self, process_func, max_workers=8, lock_stripes=64):
+        self.process_func = process_func
+        self.max_workers = max(1, max_workers)
+        self._user_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.deliveries = 0
+        self.fanned_out = 0
+        self.max_users_per_delivery = 0
+
+    def _get_executor(self):
+        # 與 EventDispatcher 相同，fork 之後在 worker 行程裡重新建立執行緒池
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="webhook-batch")
+            return self._executor
+
+    def dispatch(self, json_body, url_root):
+        """
+        處理一次 webhook 的所有事件，全部完成才回傳。
+        有事件失敗時丟出 BatchDispatchError，只列出失敗與同一位使用者在它之後沒處理到的事件，
+        其他使用者已經處理完（也已經回覆）的事件不算在內。
+        """
+        groups = group_events_by_user(json_body)
+        with self._lock:
+            self.deliveries += 1
+            self.max_users_per_delivery = max(self.max_users_per_delivery, len(groups))
+            if len(groups) > 1:
+                self.fanned_out += 1
+        if not groups:
+            return
+
+        # 第一組在目前的 request 執行緒處理，其餘交給執行緒池
+        executor = self._get_executor() if len(groups) > 1 else None
+        futures = [executor.submit(self._process_group, user_key, bodies, url_root) for user_key, bodies in groups[1:]]
+        errors = []
+        failed_event_ids = []
+        try:
+            self._process_group(groups[0][0], groups[0][1], url_root)
+        except BatchDispatchError as e:
+            errors.append(e.cause)
+            failed_event_ids.extend(e.failed_event_ids)
+        for future in futures:
+            try:
+                future.result()
+            except BatchDispatchError as e:
+                errors.append(e.cause)
+                failed_event_ids.extend(e.failed_event_ids)
+        if errors:
+            raise BatchDispatchError(errors[0], [event_id for event_id in failed_event_ids if event_id])
+
+    def _process_group(self, user_key, bodies, url_root):
+        with self._user_locks[hash(user_key) % len(self._user_locks)]:
+            for index, body in enumerate(bodies):
+                try:
+                    self.process_func(WebhookJob(None, user_key, body, url_root, time.time()))
+                except Exception as e:
+                    # 同一個使用者後面的事件不能跳過失敗的事件先處理，一起交給 LINE 重送
+                    raise BatchDispatchError(e, [body_event_id(rest) for rest in bodies[index:]]) from e
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "deliveries": self.deliveries,
+                "fanned_out": self.fanned_out,
+                "max_users_per_delivery": self.max_users_per_delivery,
+            }
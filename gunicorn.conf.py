@@ -0,0 +1,18 @@
+import os
+import shutil
+
+# gunicorn 啟動時會自動讀取工作目錄下的 gunicorn.conf.py
+
+
+def on_starting(server):
+    # 重新啟動時清掉上一輪 worker 留下的 metrics 檔案，counter 從 0 開始（Prometheus 會當成 reset 處理）
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # worker 結束後它的 livesum gauge（佇列深度、忙碌中的 worker）不再計入
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -3,10 +3,12 @@ from flask import Flask, request, abort
 from linebot.v3.webhook import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import MessagingApi, Configuration, ApiClient
-from linebot.v3.messaging.models import TextMessage, ReplyMessageRequest
+from linebot.v3.messaging.models import TextMessage, ImageMessage, ReplyMessageRequest
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 from dotenv import load_dotenv
 
+from command_router import CommandRouter
+
 # 讀取 .env 檔案
 load_dotenv()
 
@@ -40,39 +42,47 @@ def callback():
 
     return 'OK'
 
+def text_reply(text):
+    return lambda user_msg: [TextMessage(text=text)]
+
+def campus_map_reply(user_msg):
+    # 回傳東吳大學地圖圖片
+    image_url = "https://drive.google.com/uc?export=download&id=1uYUx4G_3UGhBd4Oj6GBYZzcxCcxPe_Kx" # google drive 的url
+    #https://www.dropbox.com/scl/fi/ridqgh04r6j545eo73xbe/.jpg?rlkey=6qlnd92eoxcs0cz65237p94wh&st=lpitrnq1&raw=1 這個為dropbox 的url(備用)
+    #無法開啟圖片，之後要放上去要透過huggingface上傳圖片然後取得公開url再放入image_url=這裡面
+    return [
+        ImageMessage(original_content_url=image_url, preview_image_url=image_url),
+        TextMessage(text="這是東吳大學外雙溪校區的地圖！")
+    ]
+
+# 關鍵字指令表：訊息裡有關鍵字就回覆，同時符合多個時以先列出的為準
+commands = (
+    CommandRouter(normalize=str.lower)
+    .contains("課程", "course", text_reply("這是課程查詢功能喔 📚（之後會接資料庫）"))
+    .contains("成績", "grade", text_reply("這是成績查詢功能 📊（之後會接學生資料）"))
+    .contains("活動", "activity", text_reply("這是活動資訊功能 🎉"))
+    .contains("屁眼", "party", text_reply("派對"))
+    .contains("bruh", "bruh", text_reply("eww"))
+    .contains("poordog", "poordog", text_reply("that's me🤌🏻"))
+    .contains("校園地圖", "campus_map", campus_map_reply)
+    .compile()
+)
+
 # 收到文字訊息事件時回覆
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     user_msg = event.message.text.lower()
 
-    if "課程" in user_msg:
-        reply_text = "這是課程查詢功能喔 📚（之後會接資料庫）"
-    elif "成績" in user_msg:
-        reply_text = "這是成績查詢功能 📊（之後會接學生資料）"
-    elif "活動" in user_msg:
-        reply_text = "這是活動資訊功能 🎉"
-    elif "屁眼" in user_msg:
-        reply_text = "派對"
-    elif "bruh" in user_msg:
-        reply_text = "eww"
-    elif "poordog" in user_msg:
-        reply_text = "that's me🤌🏻"
-    elif "校園地圖" in user_msg:
-        # 回傳東吳大學地圖圖片
-        image_url = "https://drive.google.com/uc?export=download&id=1uYUx4G_3UGhBd4Oj6GBYZzcxCcxPe_Kx" # google drive 的url
-        #https://www.dropbox.com/scl/fi/ridqgh04r6j545eo73xbe/.jpg?rlkey=6qlnd92eoxcs0cz65237p94wh&st=lpitrnq1&raw=1 這個為dropbox 的url(備用)
-        #無法開啟圖片，之後要放上去要透過huggingface上傳圖片然後取得公開url再放入image_url=這裡面
-        reply_messages = [
-            ImageMessage(original_content_url=image_url, preview_image_url=image_url),
-            TextMessage(text="這是東吳大學外雙溪校區的地圖！")
-        ]
+    command = commands.match(user_msg)
+    if command is not None:
+        messages = command.handler(user_msg)
     else:
-        reply_text = f"你說了: {user_msg}，但我聽不懂😅"
+        messages = [TextMessage(text=f"你說了: {user_msg}，但我聽不懂😅")]
 
     line_bot_api.reply_message(
         ReplyMessageRequest(
             reply_token=event.reply_token,
-            messages=[TextMessage(text=reply_text)]
+            messages=messages
         )
     )
 
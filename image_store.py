@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from collections import namedtuple
+
+_pil_image = None
+_pil_loaded = False
+
+def _load_pil():
+    # Pillow 在第一次產生縮圖時才 import，不拖慢 worker 啟動
+    global _pil_image, _pil_loaded
+    if not _pil_loaded:
+        try:
+            from PIL import Image
+            _pil_image = Image
+        except ImportError:
+            logging.warning("WARNING: Pillow is not installed. Uploaded images will be served without resized renditions.")
+        _pil_loaded = True
+    return _pil_image
+
+
+# <sha256>.jpg 或 <sha256>_<rendition>.jpg
+STORED_FILENAME_PATTERN = re.compile(r'^([0-9a-f]{64})(_[a-z]+)?\.[a-z]+$')
+# 舊版的 <uuid>_<LINE 訊息 id>.jpg
+LEGACY_FILENAME_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_[0-9A-Za-z]+\.jpg$')
+# 寫到一半的暫存檔
+TEMP_PREFIX = 'tmp'
+TEMP_FILENAME_PATTERN = re.compile(r'^tmp[0-9a-z_]+\.part$')
+
+def _current_umask():
+    # os.umask 只能用「設定再還原」的方式讀取，不是執行緒安全的，所以只在 import 時讀一次
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# mkstemp 建立的檔案是 0600；改回一般 open() 會得到的權限，前端伺服器（X-Sendfile、CDN 來源）才讀得到
+_FILE_MODE = 0o666 & ~_current_umask()
+
+StoredImage = namedtuple("StoredImage", ["digest", "filename", "carousel_filename", "duplicate", "size"])
+
+
+class ImageStore:
+    """
+    以內容雜湊命名的圖片儲存區。
+
+    下載時邊寫檔邊算 sha256，同一張圖重傳只會留一份檔案，
+    另外產生輪播卡片用的縮小版（carousel），列表不必載入原圖。
+    """
+
+    def __init__(self, folder, chunk_size=64 * 1024, carousel_size=720):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.renditions = {"carousel": carousel_size}
+
+    @staticmethod
+    def digest_of(filename):
+        # 內容雜湊命名的檔案回傳雜湊值，其他（舊的 uuid 檔名、.part）回傳 None
+        match = STORED_FILENAME_PATTERN.match(filename)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def is_managed(filename):
+        # 只有這個程式自己產生的檔名才算；資料夾裡的其他檔案（.gitkeep、資料庫等）一律不碰
+        return any(pattern.match(filename) for pattern in
+                   (STORED_FILENAME_PATTERN, LEGACY_FILENAME_PATTERN, TEMP_FILENAME_PATTERN))
+
+    def ingest(self, chunks, extension='.jpg'):
+        os.makedirs(self.folder, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=TEMP_PREFIX, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), _FILE_MODE)
+                for chunk in chunks:
+                    if chunk:
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+            digest = digest.hexdigest()
+            filename = f"{digest}{extension}"
+            path = os.path.join(self.folder, filename)
+            try:
+                # 重複的圖片沿用既有檔案，順便更新 mtime，janitor 就會把它當成剛寫入的檔案而不刪除
+                os.utime(path)
+                duplicate = True
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                duplicate = False
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        rendition_files = {name: self._ensure_rendition(path, digest, name, size)
+                           for name, size in self.renditions.items()}
+        return StoredImage(digest, filename, rendition_files["carousel"], duplicate, size)
+
+    def _ensure_rendition(self, source_path, digest, name, size):
+        Image = _load_pil()
+        if Image is None:
+            return None
+        filename = f"{digest}_{name}.jpg"
+        path = os.path.join(self.folder, filename)
+        try:
+            os.utime(path)
+            return filename
+        except FileNotFoundError:
+            pass
+        tmp_path = None
+        try:
+            with Image.open(source_path) as img:
+                # JPEG 可以在解碼時就縮小，省下完整解碼的記憶體
+                img.draft('RGB', (size, size))
+                img.thumbnail((size, size))
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=TEMP_PREFIX, suffix='.part')
+                with os.fdopen(fd, 'wb') as f:
+                    os.fchmod(f.fileno(), _FILE_MODE)
+                    img.save(f, 'JPEG', quality=80, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            return filename
+        except Exception as e:
+            logging.error(f"ERROR: Failed to create {name} rendition for {digest}: {e}", exc_info=True)
+            # 存檔失敗時不要留下寫到一半的 .part
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
@@ -0,0 +1,178 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from image_store import ImageStore
+
+
+class Janitor:
+    """
+    定期清理資料庫與上傳資料夾。
+
+    - 超過 state_ttl 沒有動靜的使用者狀態（上報到一半就離開）
+    - 超過 item_ttl 還沒填完位置、也沒有人在上報中的失物，連同圖片檔一起刪除
+    - 上傳資料夾裡沒有任何失物引用的上傳檔（含下載到一半留下的 .part）；只看程式自己產生的檔名
+    - 最後做 incremental VACUUM / ANALYZE
+
+    dry_run=True 時只產生報告，不做任何修改。
+    """
+
+    def __init__(self, db_manager, upload_folder, item_ttl=86400, state_ttl=21600, upload_grace=3600,
+                 vacuum_pages=0, interval=3600):
+        self.db_manager = db_manager
+        self.upload_folder = upload_folder
+        self.item_ttl = item_ttl
+        self.state_ttl = state_ttl
+        self.upload_grace = upload_grace
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.last_report = None
+
+    def start(self):
+        # gunicorn fork 之後才在 worker 行程裡啟動；多個 worker 之間用 db_meta 的租約避免重複執行
+        with self._lock:
+            if self._pid == os.getpid() or self.interval <= 0:
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run_forever, name="janitor", daemon=True).start()
+
+    def _run_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.db_manager.try_acquire_lease('janitor_last_run', time.time(), self.interval * 0.9):
+                    self.run()
+            except Exception as e:
+                logging.error(f"ERROR: Janitor run failed: {e}", exc_info=True)
+
+    def run(self, dry_run=False):
+        started = time.perf_counter()
+        now = time.time()
+        report = {"dry_run": dry_run}
+
+        stale_states = self.db_manager.expire_stale_user_states(now - self.state_ttl, dry_run=dry_run)
+        report["stale_states"] = [{"user_id": user_id, "state": state, "item_id": item_id}
+                                  for user_id, state, item_id in stale_states]
+
+        # dry run 時過期的狀態還在資料表裡，所以以 updated_at 判斷上報流程是否還活著
+        abandoned = self.db_manager.find_abandoned_lost_items(
+            datetime.fromtimestamp(now - self.item_ttl).isoformat(),
+            live_states_after=now - self.state_ttl,
+        )
+        deleted_ids = [item_id for item_id, _ in abandoned]
+        if not dry_run:
+            deleted_ids = self.db_manager.delete_lost_items(deleted_ids, incomplete_only=True)
+        deleted = set(deleted_ids)
+        report["abandoned_items"] = [{"item_id": item_id, "report_date": report_date}
+                                     for item_id, report_date in abandoned if item_id in deleted]
+
+        # 刪掉失物之後才掃資料夾，它們的圖片（沒被其他失物共用時）會變成孤兒檔案一起清掉
+        orphans = self._find_orphan_uploads(now, exclude_item_ids=deleted if dry_run else None)
+        if not dry_run:
+            orphans = [(name, size) for name, size in orphans if self._remove_orphan(name)]
+        report["orphan_uploads"] = [name for name, _ in orphans]
+        report["orphan_upload_bytes"] = sum(size for _, size in orphans)
+
+        before = self.db_manager.database_size()
+        if not dry_run:
+            self.db_manager.compact(vacuum_pages=self.vacuum_pages)
+        after = self.db_manager.database_size()
+        report["database"] = {"before": before, "after": after}
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        self.runs += 1
+        self.last_report = report
+        logging.info(
+            f"INFO: Janitor {'dry run' if dry_run else 'run'}: {len(report['stale_states'])} stale states, "
+            f"{len(report['abandoned_items'])} abandoned items, {len(orphans)} orphan uploads "
+            f"({report['orphan_upload_bytes']} bytes), freelist {before['freelist_count']} -> {after['freelist_count']} pages."
+        )
+        return report
+
+    def _remove_orphan(self, name):
+        # 掃描到刪除之間 ImageStore.ingest 可能剛好重用了同一個檔案，刪之前再確認一次 mtime 與資料庫引用
+        path = os.path.join(self.upload_folder, name)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.upload_grace:
+                return False
+            if self.db_manager.is_upload_referenced(ImageStore.digest_of(name) or name):
+                return False
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _find_orphan_uploads(self, now, exclude_item_ids=None):
+        if not os.path.isdir(self.upload_folder):
+            return []
+        referenced_names = set()
+        referenced_digests = set()
+        for item_id, image_url, thumbnail_url in self.db_manager.iter_item_uploads():
+            if exclude_item_ids and item_id in exclude_item_ids:
+                continue
+            for url in (image_url, thumbnail_url):
+                if not url:
+                    continue
+                name = url.rsplit('/', 1)[-1]
+                referenced_names.add(name)
+                digest = ImageStore.digest_of(name)
+                if digest:
+                    referenced_digests.add(digest)
+
+        orphans = []
+        with os.scandir(self.upload_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not ImageStore.is_managed(entry.name):
+                    continue
+                stat = entry.stat()
+                # 剛寫進來的檔案可能還沒存進資料庫，給一段寬限時間
+                if now - stat.st_mtime < self.upload_grace:
+                    continue
+                if entry.name in referenced_names:
+                    continue
+                # 同一張圖的縮圖跟著原圖走，有任何一個尺寸被引用就全部保留
+                digest = ImageStore.digest_of(entry.name)
+                if digest and digest in referenced_digests:
+                    continue
+                orphans.append((entry.name, stat.st_size))
+        return orphans
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "interval_seconds": self.interval,
+            "last_report": None if self.last_report is None else {
+                key: len(value) if isinstance(value, list) else value
+                for key, value in self.last_report.items()
+            },
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    from config import Config
+    from db_manager import DBManager
+
+    parser = argparse.ArgumentParser(description='Clean up abandoned lost item reports, stale states and orphan uploads.')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    parser.add_argument('--item-ttl', type=float, default=Config.JANITOR_ITEM_TTL)
+    parser.add_argument('--state-ttl', type=float, default=Config.JANITOR_STATE_TTL)
+    parser.add_argument('--upload-grace', type=float, default=Config.JANITOR_UPLOAD_GRACE)
+    args = parser.parse_args()
+
+    janitor = Janitor(
+        DBManager(Config.SQLITE_DB_PATH, busy_timeout_ms=Config.SQLITE_BUSY_TIMEOUT_MS),
+        Config.UPLOAD_FOLDER,
+        item_ttl=args.item_ttl,
+        state_ttl=args.state_ttl,
+        upload_grace=args.upload_grace,
+        vacuum_pages=Config.JANITOR_VACUUM_PAGES,
+    )
+    print(json.dumps(janitor.run(dry_run=args.dry_run), ensure_ascii=False, indent=2))
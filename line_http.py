@@ -0,0 +1,228 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, RequestsHttpResponse
+
+# 暫時性的錯誤才重試；4xx（除了 429）重送也不會成功
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# 一次 reply 最多 5 則訊息
+MAX_REPLY_MESSAGES = 5
+
+
+class RetryBudget:
+    """
+    重試預算：每個 request 存入 ratio 個 token，每次重試花掉 1 個。
+    LINE 整個掛掉時重試量最多只會多出 ratio 倍，不會把對方打得更慘。
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+
+class PooledHttpClient(HttpClient):
+    """
+    給 line-bot-sdk 用的 HttpClient：共用 requests.Session（連線池 + keep-alive），
+    暫時性錯誤以 jitter 指數退避重試，並受 RetryBudget 限制。
+    """
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT, pool_size=10, max_retries=2,
+                 backoff_base=0.2, backoff_max=2.0, retry_budget=None, content_timeout=None, metrics=None):
+        super(PooledHttpClient, self).__init__(timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget or RetryBudget()
+        self.content_timeout = content_timeout
+        self.metrics = metrics
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.failures = 0
+        self.sessions_created = 0
+
+    def _get_session(self):
+        # fork 之後不能共用父行程的 socket，依 pid 重新建立
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+                self.sessions_created += 1
+            return self._session
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response is not None and response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # full jitter：在 0 到指數上限之間隨機，避免所有 worker 同時重試
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        session = self._get_session()
+        timeout = timeout if timeout is not None else self.timeout
+        with self._lock:
+            self.requests += 1
+        self.retry_budget.deposit()
+
+        attempt = 0
+        while True:
+            response = None
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+                self._observe(method, url, response.status_code, started)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._observe(method, url, type(e).__name__, started)
+                error = e
+
+            if attempt >= self.max_retries or not self.retry_budget.withdraw():
+                if attempt < self.max_retries:
+                    with self._lock:
+                        self.budget_exhausted += 1
+                with self._lock:
+                    self.failures += 1
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self._backoff(attempt, response)
+            logging.warning(
+                f"WARNING: LINE API {method} {url} failed "
+                f"({error or response.status_code}), retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})."
+            )
+            if response is not None:
+                response.close()
+            with self._lock:
+                self.retries += 1
+            if self.metrics is not None:
+                self.metrics.count_line_api_retry(method, url)
+            time.sleep(delay)
+            attempt += 1
+
+    def _observe(self, method, url, status, started):
+        # 每次嘗試各記一筆；stream 下載只算到收到 header 為止
+        if self.metrics is not None:
+            self.metrics.observe_line_api(method, url, status, time.perf_counter() - started)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        if timeout is None and stream and self.content_timeout is not None:
+            # 圖片等內容下載用較長的讀取逾時
+            timeout = self.content_timeout
+        return RequestsHttpResponse(self._request('GET', url, headers=headers, params=params, stream=stream, timeout=timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self._request('POST', url, headers=headers, data=data, timeout=timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self._request('DELETE', url, headers=headers, data=data, timeout=timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self._request('PUT', url, headers=headers, data=data, timeout=timeout))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "budget_exhausted": self.budget_exhausted,
+                "failures": self.failures,
+                "retry_budget_tokens": round(self.retry_budget.tokens, 2),
+                "sessions_created": self.sessions_created,
+            }
+
+
+class CoalescingLineBotApi(LineBotApi):
+    """
+    在 collect_replies() 範圍內，對同一個 reply token 的多次 reply_message 先暫存，
+    離開時合併成一次 API 呼叫（最多 5 則訊息）。reply token 只能用一次，
+    合併之後 handler 就算分好幾次回覆也不會失敗。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CoalescingLineBotApi, self).__init__(*args, **kwargs)
+        self._pending = threading.local()
+        self.coalesced = 0
+
+    @contextmanager
+    def collect_replies(self):
+        if getattr(self._pending, 'replies', None) is not None:
+            yield
+            return
+        self._pending.replies = {}
+        try:
+            yield
+        except BaseException:
+            # handler 中途出錯也要把已經準備好的回覆送出去，與原本逐次呼叫的行為一致；
+            # 送出失敗只記錄下來，往外丟的仍是 handler 原本的例外
+            replies, self._pending.replies = self._pending.replies, None
+            try:
+                self._flush(replies)
+            except Exception as e:
+                logging.error(f"ERROR: Failed to send replies after a handler error: {e}", exc_info=True)
+            raise
+        replies, self._pending.replies = self._pending.replies, None
+        self._flush(replies)
+
+    def _flush(self, replies):
+        for reply_token, (messages, notification_disabled) in replies.items():
+            if len(messages) > MAX_REPLY_MESSAGES:
+                logging.warning(f"WARNING: Dropping {len(messages) - MAX_REPLY_MESSAGES} message(s) beyond the reply limit.")
+            super(CoalescingLineBotApi, self).reply_message(
+                reply_token, messages[:MAX_REPLY_MESSAGES], notification_disabled=notification_disabled)
+
+    def reply_message(self, reply_token, messages, notification_disabled=False, timeout=None):
+        replies = getattr(self._pending, 'replies', None)
+        if replies is None:
+            return super(CoalescingLineBotApi, self).reply_message(
+                reply_token, messages, notification_disabled=notification_disabled, timeout=timeout)
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        if reply_token in replies:
+            self.coalesced += 1
+            replies[reply_token][0].extend(messages)
+        else:
+            replies[reply_token] = (list(messages), notification_disabled)
+
+    def stats(self):
+        stats = self.http_client.stats() if hasattr(self.http_client, 'stats') else {}
+        stats["coalesced_replies"] = self.coalesced
+        return stats
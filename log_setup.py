@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from collections import OrderedDict
+
+# LogRecord 本身就有的屬性，其他的（logging 的 extra=...）才當成結構化欄位輸出
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """一筆紀錄輸出成一行 JSON，extra 傳進來的欄位會原樣帶出。"""
+
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """一般文字格式；extra 傳進來的欄位以 key=value 接在訊息後面，不會被丟掉。"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = [
+            f"{key}={json.dumps(value, ensure_ascii=False, default=str)}"
+            for key, value in record.__dict__.items()
+            if key not in _RESERVED_ATTRS and not key.startswith("_")
+        ]
+        return f"{message} {' '.join(fields)}" if fields else message
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    標準的 QueueHandler 會在呼叫端執行緒先把訊息 format 好；
+    這裡直接把 record 丟進佇列，格式化與寫出都交給背景的 QueueListener。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class LogSampler:
+    """依比例抽樣，用來控制 request body / header 這類大量輸出的頻率。"""
+
+    def __init__(self, rate):
+        self.rate = max(0.0, min(1.0, rate))
+
+    def sample(self):
+        if self.rate <= 0.0:
+            return False
+        return self.rate >= 1.0 or random.random() < self.rate
+
+
+_listener = None
+_hooks_registered = False
+
+
+def configure_logging(level="INFO", fmt="json", queue_size=10000):
+    """
+    把 root logger 換成非同步輸出：呼叫端只做 queue.put，
+    真正的格式化與 stdout 寫入在 QueueListener 的執行緒完成。
+    佇列滿的時候直接丟掉，不讓 log 拖慢 webhook。
+    """
+    global _listener, _hooks_registered
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.enqueue = lambda record: _enqueue_nowait(log_queue, record)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    if not _hooks_registered:
+        _hooks_registered = True
+        atexit.register(_stop_listener)
+        # gunicorn --preload 時 fork 之後執行緒不會跟著過去，要在子行程重新啟動
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_listener)
+    return _listener
+
+
+def _enqueue_nowait(log_queue, record):
+    try:
+        log_queue.put_nowait(record)
+    except queue.Full:
+        pass
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_listener():
+    if _listener is not None:
+        _listener._thread = None
+        _listener.start()
+
+
+class Timer:
+    """量測一段程式的耗時（毫秒），用在結構化紀錄的 duration_ms 欄位。"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    @property
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 2)
+
+
+class StartupTimer:
+    """記錄啟動時各階段的耗時（毫秒），開機完成後輸出成一筆結構化紀錄。"""
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.perf_counter()
+        self._last = self.start
+        self.phases = OrderedDict()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 2)
+        self._last = now
+
+    def as_dict(self):
+        return {
+            "startup_ms": round((self._last - self.start) * 1000, 2),
+            "phases": dict(self.phases),
+        }
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import sys
+
+from db_manager import EXPORT_FIELDS
+
+FORMATS = ('jsonl', 'csv')
+
+
+def guess_format(path, default='jsonl'):
+    if path and path.lower().endswith('.csv'):
+        return 'csv'
+    if path and path.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return default
+
+
+def iter_export(items, fmt='jsonl'):
+    """把失物逐筆轉成文字（每筆一行）；items 通常是 DBManager.iter_lost_items()，全程不會整批放進記憶體。"""
+    if fmt == 'jsonl':
+        for item in items:
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+    elif fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for item in items:
+            writer.writerow(item)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+
+def _parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 't')
+    return bool(value)
+
+
+def _parse_float(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def _coerce_item(row):
+    # CSV 的欄位都是字串，空字串當成沒有值；JSONL 原本的型別也一併正規化
+    item = {key: (None if value == '' else value) for key, value in row.items() if key}
+    for field in ('latitude', 'longitude'):
+        if field in item:
+            item[field] = _parse_float(item[field])
+    if 'is_resolved' in item:
+        item['is_resolved'] = _parse_bool(item['is_resolved'])
+    return item
+
+
+def iter_import(lines, fmt='jsonl'):
+    """逐行讀取 JSONL / CSV，產生可以交給 DBManager.import_lost_items 的 dict。"""
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON on line {line_number}: {e}") from e
+            yield _coerce_item(row)
+    elif fmt == 'csv':
+        for row in csv.DictReader(lines):
+            yield _coerce_item(row)
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _read_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+
+    from config import Config
+    from db_manager import DBManager
+
+    parser = argparse.ArgumentParser(description='Bulk export, import and resolve lost items.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='stream lost items to JSONL or CSV')
+    export_parser.add_argument('--output', '-o', help='output file (default: stdout)')
+    export_parser.add_argument('--format', choices=FORMATS, help='default: from the file extension, else jsonl')
+    export_parser.add_argument('--status', choices=('all', 'open', 'resolved'), default='all')
+    export_parser.add_argument('--after', help='only items reported at or after this ISO date')
+    export_parser.add_argument('--before', help='only items reported before this ISO date')
+
+    import_parser = subparsers.add_parser('import', help='bulk load lost items from JSONL or CSV')
+    import_parser.add_argument('input', help="input file ('-' for stdin)")
+    import_parser.add_argument('--format', choices=FORMATS, help='default: from the file extension, else jsonl')
+    import_parser.add_argument('--user-id', default='front_desk', help='user_id for rows that do not have one')
+    import_parser.add_argument('--replace', action='store_true', help='overwrite items whose item_id already exists')
+    import_parser.add_argument('--batch-size', type=int, default=500)
+
+    resolve_parser = subparsers.add_parser('resolve', help='mark lost items as returned')
+    resolve_parser.add_argument('--ids', nargs='+', help='item ids to resolve')
+    resolve_parser.add_argument('--ids-file', help='file with one item id per line')
+    resolve_parser.add_argument('--after', help='only items reported at or after this ISO date')
+    resolve_parser.add_argument('--before', help='only items reported before this ISO date')
+    resolve_parser.add_argument('--reopen', action='store_true', help='mark the items as unresolved instead')
+
+    args = parser.parse_args()
+    db_manager = DBManager(Config.SQLITE_DB_PATH, busy_timeout_ms=Config.SQLITE_BUSY_TIMEOUT_MS)
+
+    if args.command == 'export':
+        fmt = args.format or guess_format(args.output)
+        resolved = {'all': None, 'open': False, 'resolved': True}[args.status]
+        items = db_manager.iter_lost_items(resolved=resolved, reported_after=args.after, reported_before=args.before)
+        out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            for chunk in iter_export(items, fmt):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+
+    elif args.command == 'import':
+        fmt = args.format or guess_format(args.input)
+        source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8-sig', newline='')
+        try:
+            imported, skipped = db_manager.import_lost_items(
+                iter_import(source, fmt), user_id=args.user_id, replace=args.replace, batch_size=args.batch_size)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        logging.info(f"INFO: Imported {imported} lost items, skipped {skipped} existing ones.")
+        print(json.dumps({"imported": imported, "skipped": skipped}))
+
+    elif args.command == 'resolve':
+        item_ids = None
+        if args.ids or args.ids_file:
+            item_ids = (args.ids or []) + (_read_ids(args.ids_file) if args.ids_file else [])
+        if item_ids is None and not (args.after or args.before):
+            parser.error('resolve needs --ids, --ids-file or a date range (--after / --before)')
+        changed = db_manager.resolve_lost_items(
+            item_ids, reported_after=args.after, reported_before=args.before, resolved=not args.reopen)
+        print(json.dumps({"changed": changed}))
@@ -0,0 +1,122 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# 角色存成一個位元組大小的整數，不必每則訊息都存字串
+ROLES = ("user", "bot")
+_ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+class ChatHistoryStore:
+    """
+    網頁聊天紀錄的伺服器端儲存，取代把整份 chat_history 放進 Flask-Session 檔案。
+
+    - 每則訊息是 SQLite 裡的一列，新增對話只 INSERT 新的兩列，不重寫整份歷史
+    - 每個 session 只保留最新的 max_messages 則，讀取時也只讀這幾列
+    - 超過 idle_ttl 秒沒有新訊息的 session 每隔 sweep_interval 秒清掉一次
+    這樣不論聊多久，每個 request 的讀寫量都是固定的；session cookie 裡只需要放對話 id。
+    """
+
+    def __init__(self, db_path, max_messages=50, idle_ttl=7 * 24 * 3600, sweep_interval=3600):
+        self.db_path = db_path
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        self._create_tables()
+
+    def _get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_tables(self):
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                session_id TEXT PRIMARY KEY,
+                last_seen REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_seen ON chat_sessions (last_seen)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+        ''')
+
+    def load(self, session_id):
+        """回傳最新的 max_messages 則訊息 [{"role", "text"}, ...]，由舊到新。"""
+        try:
+            rows = self._get_connection().execute(
+                "SELECT role, text FROM chat_messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, self.max_messages)).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"ERROR: Failed to load chat history: {e}")
+            return []
+        return [{"role": ROLES[role], "text": text} for role, text in reversed(rows)]
+
+    def append(self, session_id, messages):
+        """messages 是 [(role, text), ...]；寫入失敗只記錄錯誤，不影響回答。"""
+        now = time.time()
+        conn = self._get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_seq = conn.execute(
+                    "SELECT MAX(seq) FROM chat_messages WHERE session_id = ?", (session_id,)).fetchone()[0] or 0
+                conn.executemany(
+                    "INSERT INTO chat_messages (session_id, seq, role, text) VALUES (?, ?, ?, ?)",
+                    [(session_id, last_seq + offset, _ROLE_CODES[role], text)
+                     for offset, (role, text) in enumerate(messages, 1)])
+                last_seq += len(messages)
+                # 超過上限的舊訊息用主鍵範圍刪掉，只會碰到剛被擠出去的那幾列
+                conn.execute("DELETE FROM chat_messages WHERE session_id = ? AND seq <= ?",
+                             (session_id, last_seq - self.max_messages))
+                conn.execute(
+                    "INSERT INTO chat_sessions (session_id, last_seen) VALUES (?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET last_seen = excluded.last_seen",
+                    (session_id, now))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if now - self._last_sweep >= self.sweep_interval:
+                self._last_sweep = now
+                self.sweep(now)
+        except sqlite3.Error as e:
+            logging.error(f"ERROR: Failed to save chat history: {e}")
+
+    def sweep(self, now=None):
+        """刪掉閒置超過 idle_ttl 的 session，回傳刪掉的 session 數。"""
+        cutoff = (now or time.time()) - self.idle_ttl
+        conn = self._get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM chat_messages WHERE session_id IN "
+                "(SELECT session_id FROM chat_sessions WHERE last_seen < ?)", (cutoff,))
+            removed = conn.execute("DELETE FROM chat_sessions WHERE last_seen < ?", (cutoff,)).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if removed:
+            logging.info(f"INFO: Removed {removed} idle chat sessions.")
+        return removed
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_tokens(text):
+    # 沒有 tokenizer 時的粗估：中日韓文字大約一字一個 token，其他字元大約四個字一個 token
+    wide = sum(1 for char in text if ord(char) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _content(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def summary_prompt(previous_summary, turns):
+    lines = ["請用繁體中文把以下對話濃縮成 300 字以內的摘要，保留使用者問過的重點與已經給過的答案："]
+    if previous_summary:
+        lines.append(f"先前的摘要：{previous_summary}")
+    for role, text in turns:
+        lines.append(f"{'使用者' if role == 'user' else '助手'}：{text}")
+    return "\n".join(lines)
+
+
+class Conversation:
+    """一位使用者（網頁 session 或 LINE user）的對話內容：較早對話的摘要，加上最近幾輪的一問一答。"""
+
+    def __init__(self):
+        self.summary = ""
+        self.turns = []  # [(role, text, tokens)]，一定是 user / model 成對
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return estimate_tokens(self.summary) + sum(turn[2] for turn in self.turns)
+
+    def history(self):
+        contents = []
+        if self.summary:
+            contents.append(_content("user", f"（先前對話的摘要）{self.summary}"))
+            contents.append(_content("model", "好的，我會參考先前的對話。"))
+        contents.extend(_content(role, text) for role, text, _ in self.turns)
+        return contents
+
+    def append(self, message, reply):
+        self.turns.append(("user", message, estimate_tokens(message)))
+        self.turns.append(("model", reply, estimate_tokens(reply)))
+
+
+class ConversationManager:
+    """
+    每個對話各自保存 Gemini 的聊天內容，取代所有人共用、歷史無限增長的單一 chat。
+
+    - 每個對話的歷史以 token_budget 為上限，超過時只留下約一半預算的最近對話，其餘交給 summarize
+      濃縮成摘要（留一半空間，才不會每一輪都要再摘要一次）；沒有 summarize 或摘要失敗時直接丟掉，
+      最新的一問一答一定保留
+    - 超過 idle_ttl 秒沒用的對話會被清掉，對話數超過 max_conversations 時淘汰最久沒用的（LRU）
+    - send(history, message) 負責實際呼叫 Gemini；conversation_id 為 None 時是不帶歷史的單次問答
+    """
+
+    def __init__(self, send, summarize=None, max_conversations=500, idle_ttl=3600,
+                 token_budget=6000, summary_budget=800):
+        self.send = send
+        self.summarize = summarize
+        self.max_conversations = max_conversations
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, conversation_id):
+        now = time.monotonic()
+        with self._lock:
+            # OrderedDict 依最後使用時間排序，從最舊的開始清掉閒置的對話
+            while self._conversations:
+                oldest_id, oldest = next(iter(self._conversations.items()))
+                if now - oldest.last_used < self.idle_ttl:
+                    break
+                del self._conversations[oldest_id]
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                conversation = self._conversations[conversation_id] = Conversation()
+            conversation.last_used = now
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+            return conversation
+
+    def send_message(self, conversation_id, message):
+        """送出訊息並回傳回應文字；呼叫失敗時往外丟，對話內容保持不變。"""
+        if conversation_id is None:
+            return self.send([], message)
+        conversation = self._get(conversation_id)
+        # 同一個對話同時只處理一則訊息，歷史的順序才會正確
+        with conversation.lock:
+            reply = self.send(conversation.history(), message)
+            conversation.append(message, reply)
+            self._trim(conversation)
+        return reply
+
+    def _trim(self, conversation):
+        if conversation.tokens <= self.token_budget:
+            return
+        # 從最新的一問一答往回算，留下不超過一半預算的部分
+        keep = 2
+        kept_tokens = sum(turn[2] for turn in conversation.turns[-2:])
+        while keep < len(conversation.turns):
+            pair_tokens = conversation.turns[-keep - 2][2] + conversation.turns[-keep - 1][2]
+            if kept_tokens + pair_tokens > self.token_budget // 2:
+                break
+            keep += 2
+            kept_tokens += pair_tokens
+        older, recent = conversation.turns[:-keep], conversation.turns[-keep:]
+        if older and self.summarize:
+            try:
+                summary = self.summarize(conversation.summary, [(role, text) for role, text, _ in older])
+                conversation.summary = (summary or "").strip()[:self.summary_budget]
+            except Exception as e:
+                logging.warning(f"WARNING: Failed to summarize conversation, dropping old turns instead: {e}")
+        # 沒有 summarize 或摘要失敗時，較早的對話就直接丟掉
+        conversation.turns = recent
+        # 最新一輪本身就超過上限時連摘要也不留
+        if conversation.tokens > self.token_budget:
+            conversation.summary = ""
+
+    def reset(self, conversation_id):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+    def __len__(self):
+        return len(self._conversations)
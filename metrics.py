@@ -0,0 +1,193 @@
+import functools
+import inspect
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+    from prometheus_client import multiprocess
+except ImportError:
+    CollectorRegistry = None
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 指令與 LINE API 的延遲多半在幾毫秒到幾秒之間
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# SQLite 操作大多在 1 毫秒以內，另外留幾個格子看寫入鎖等待
+DB_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 2.5)
+# 上傳圖片大小（bytes）：LINE 的照片通常在幾十 KB 到幾 MB
+IMAGE_SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2)
+
+# 網址裡的 message id / user id 換成 :id，避免 label 的值無限增加
+_URL_ID_PATTERN = re.compile(r'/(?:\d+|[UCR][0-9a-f]{32}|(?<=/message/)[^/]+(?=/content))(?=/|$)')
+
+
+def multiprocess_dir():
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')
+
+
+def mark_process_dead(pid):
+    # 給 gunicorn 的 child_exit hook 用：清掉已結束 worker 的 livesum gauge
+    if CollectorRegistry is not None and multiprocess_dir():
+        multiprocess.mark_process_dead(pid)
+
+
+def line_api_endpoint(url):
+    return _URL_ID_PATTERN.sub('/:id', urlsplit(url).path) or '/'
+
+
+class _NoopMetric:
+    """沒有安裝 prometheus_client 或關閉 metrics 時用的空物件，呼叫端不必另外判斷。"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+class Metrics:
+    """
+    Prometheus 格式的指標：各指令、SQLite 操作與 LINE API 呼叫的延遲分布，
+    上傳圖片大小，以及佇列深度與忙碌中的 worker 數量。
+
+    設定 PROMETHEUS_MULTIPROC_DIR 時使用 prometheus_client 的 multiprocess 模式，
+    每個 gunicorn worker 把數值寫進 mmap 檔，/metrics 讀取時再彙總所有 worker。
+    沒有安裝 prometheus_client 時所有指標都是空操作。
+    """
+
+    def __init__(self, enabled=True, namespace='lost_and_found'):
+        self.enabled = enabled and CollectorRegistry is not None
+        if enabled and CollectorRegistry is None:
+            logging.warning("WARNING: prometheus_client is not installed. /metrics will be disabled.")
+        self.namespace = namespace
+        self.multiprocess = self.enabled and bool(multiprocess_dir())
+        if self.multiprocess:
+            # 不經過 gunicorn.conf.py 啟動（例如 flask run）時資料夾可能還不存在
+            os.makedirs(multiprocess_dir(), exist_ok=True)
+        # multiprocess 模式下指標不註冊到任何 registry，輸出時由 MultiProcessCollector 從檔案彙總
+        self._registry = CollectorRegistry() if self.enabled and not self.multiprocess else None
+        self._command = threading.local()
+
+        self.command_latency = self._histogram(
+            'command_duration_seconds', 'Time spent handling a LINE event, by command.',
+            ['command', 'outcome'], LATENCY_BUCKETS)
+        self.webhook_latency = self._histogram(
+            'webhook_duration_seconds', 'Time spent answering a webhook delivery.', ['mode'], LATENCY_BUCKETS)
+        self.webhook_events = self._counter(
+            'webhook_events_total', 'Webhook events received, by outcome.', ['outcome'])
+        self.db_latency = self._histogram(
+            'db_operation_duration_seconds', 'Time spent in DBManager operations, including lock waits.',
+            ['operation', 'outcome'], DB_LATENCY_BUCKETS)
+        self.line_api_latency = self._histogram(
+            'line_api_request_duration_seconds', 'LINE API request latency per attempt.',
+            ['method', 'endpoint', 'status'], LATENCY_BUCKETS)
+        self.line_api_retries = self._counter(
+            'line_api_retries_total', 'LINE API requests retried after a transient error.', ['method', 'endpoint'])
+        self.image_bytes = self._histogram(
+            'image_upload_bytes', 'Size of images downloaded from LINE.', ['result'], IMAGE_SIZE_BUCKETS)
+        self.queue_depth = self._gauge(
+            'webhook_queue_depth', 'Webhook events waiting for a background worker.', 'livesum')
+        self.workers_busy = self._gauge(
+            'webhook_workers_busy', 'Threads currently processing webhook events.', 'livesum')
+        self.worker_threads = self._gauge(
+            'webhook_worker_threads', 'Threads available for processing webhook events.', 'livesum')
+
+    def _name(self, name):
+        return f"{self.namespace}_{name}"
+
+    def _histogram(self, name, documentation, labelnames, buckets):
+        if not self.enabled:
+            return _NoopMetric()
+        return Histogram(self._name(name), documentation, labelnames, buckets=buckets, registry=self._registry)
+
+    def _counter(self, name, documentation, labelnames):
+        if not self.enabled:
+            return _NoopMetric()
+        return Counter(self._name(name), documentation, labelnames, registry=self._registry)
+
+    def _gauge(self, name, documentation, multiprocess_mode):
+        if not self.enabled:
+            return _NoopMetric()
+        return Gauge(self._name(name), documentation, registry=self._registry, multiprocess_mode=multiprocess_mode)
+
+    def render(self):
+        """回傳 (body, content_type)。"""
+        if self.multiprocess:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self._registry
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    def track_command(self, default):
+        """
+        handler 的 decorator：量測整個 handler 的耗時，command label 預設為 default，
+        handler 內可以用 set_command() 改成實際走到的分支。
+        line-bot-sdk 依參數個數決定要不要多傳 destination，所以 wrapper 只收 event。
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(event):
+                self._command.name = default
+                outcome = 'error'
+                started = time.perf_counter()
+                try:
+                    result = func(event)
+                    outcome = 'ok'
+                    return result
+                finally:
+                    self.command_latency.labels(self._command.name, outcome).observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def set_command(self, name):
+        self._command.name = name
+
+    def instrument_db(self, db_manager):
+        # 把 DBManager 的公開方法（以及所有寫入都會經過的 _write）換成計時的版本；
+        # 只包在這個物件上，不動到類別本身。產生器（iter_*）的耗時在迭代時才發生，不包。
+        if not self.enabled:
+            return db_manager
+        names = [name for name, attr in vars(type(db_manager)).items()
+                 if callable(attr) and not name.startswith('_') and not inspect.isgeneratorfunction(attr)]
+        for name in names + ['_write']:
+            setattr(db_manager, name, self._timed_db_operation(getattr(db_manager, name), name.lstrip('_')))
+        return db_manager
+
+    def _timed_db_operation(self, method, operation):
+        ok = self.db_latency.labels(operation, 'ok')
+        error = self.db_latency.labels(operation, 'error')
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                error.observe(time.perf_counter() - started)
+                raise
+            ok.observe(time.perf_counter() - started)
+            return result
+        return wrapper
+
+    def observe_line_api(self, method, url, status, seconds):
+        self.line_api_latency.labels(method, line_api_endpoint(url), str(status)).observe(seconds)
+
+    def count_line_api_retry(self, method, url):
+        self.line_api_retries.labels(method, line_api_endpoint(url)).inc()
+
+    def observe_image(self, size, duplicate):
+        self.image_bytes.labels('duplicate' if duplicate else 'stored').observe(size)
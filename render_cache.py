@@ -0,0 +1,94 @@
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+
+RenderedPage = namedtuple("RenderedPage", ["generation", "flex_json", "text_json", "is_empty"])
+
+
+class PreserializedMessage:
+    """
+    已經序列化好的 LINE 訊息。LineBotApi.reply_message 只會呼叫 as_json_dict，
+    所以直接回傳快取的 JSON，不用每次重建整棵 Flex 物件樹。
+    """
+
+    def __init__(self, json_text):
+        self.json_text = json_text
+
+    def as_json_dict(self):
+        return json.loads(self.json_text)
+
+
+class RenderCache:
+    """
+    依 key（例如分頁 cursor）快取渲染好的失物列表。
+
+    generation 由呼叫端提供（資料庫裡的 listing_epoch），不一致就代表資料已變動。
+    重建期間其他讀者直接拿上一版，不會排隊等新的版本產生。
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._build_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.builds = 0
+
+    def get(self, key, generation, builder):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        if entry is not None:
+            # 已經有人在重建，先回傳舊版本
+            if not build_lock.acquire(blocking=False):
+                with self._lock:
+                    self.stale_hits += 1
+                return entry
+        else:
+            build_lock.acquire()
+
+        try:
+            with self._lock:
+                current = self._entries.get(key)
+                if current is not None and current.generation == generation:
+                    self.hits += 1
+                    return current
+                self.misses += 1
+
+            flex_json, text_json, is_empty = builder()
+            entry = RenderedPage(generation, flex_json, text_json, is_empty)
+
+            with self._lock:
+                current = self._entries.get(key)
+                if current is None or current.generation <= generation:
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+                self.builds += 1
+                while len(self._entries) > self.max_entries:
+                    old_key, _ = self._entries.popitem(last=False)
+                    self._build_locks.pop(old_key, None)
+            return entry
+        finally:
+            build_lock.release()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "builds": self.builds,
+            }
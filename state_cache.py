@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserStateCache:
+    """
+    放在 DBManager 前面的使用者狀態快取（LRU + TTL）。
+
+    每筆快取都帶著讀取（或寫入）當下的 state_epoch 當作版本。DBManager 發現 SQLite 被其他連線
+    （例如其他 gunicorn worker）改過時，會把 user_states 裡 version 比快取 epoch 新的
+    (user_id, version) 傳給 sync_epoch，只清掉比那個版本舊的快取，其他使用者的快取照常使用。
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.epoch = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            state, item_id, negative, expires_at, _ = entry
+            if expires_at <= now:
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            if negative:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return state, item_id
+
+    def put(self, user_id, state, item_id, epoch, negative=False):
+        ttl = self.negative_ttl if negative else self.ttl
+        with self._lock:
+            # 讀取時的 epoch 比目前舊，代表這筆資料可能已經過期，不放進快取
+            if self.epoch is None or epoch < self.epoch:
+                return
+            self._entries[user_id] = (state, item_id, negative, time.monotonic() + ttl, epoch)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def sync_epoch(self, epoch, changes=()):
+        # changes 是 epoch 變動期間被改過的 [(user_id, version), ...]
+        with self._lock:
+            if self.epoch is not None and epoch < self.epoch:
+                # epoch 倒退代表資料庫被換掉了，快取裡的東西都不能信
+                if self._entries:
+                    self._entries.clear()
+                    self.flushes += 1
+                self.epoch = epoch
+                return
+            for user_id, version in changes:
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[4] < version:
+                    del self._entries[user_id]
+                    self.invalidations += 1
+            self.epoch = epoch
+
+    def advance_epoch(self, old_epoch, new_epoch):
+        with self._lock:
+            # 中間有其他連線寫過（old_epoch 對不上）時先不前進，
+            # 留給下一次 sync_epoch 查出那段期間改了誰再一起前進
+            if old_epoch == self.epoch:
+                self.epoch = new_epoch
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.epoch = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "epoch": self.epoch,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "flushes": self.flushes,
+                "invalidations": self.invalidations,
+            }
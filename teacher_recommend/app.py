@@ -1,4 +1,5 @@
 import os
+import hashlib
 import logging
 from flask import Flask, request, abort, render_template
 from bs4 import BeautifulSoup
@@ -20,7 +21,8 @@ from linebot.v3.messaging import (
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
-from scudcard import google_search_dcard
+from scudcard import google_search_dcard, search_cache, search_engine, CACHE_PATH
+from result_cache import ResultCache, normalize_keyword
 
 # 初始化 Gemini AI
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -28,13 +30,11 @@ client = genai.Client(api_key=GOOGLE_API_KEY)
 google_search_tool = Tool(
     google_search=GoogleSearch()
 )
-chat = client.chats.create(
-    model="gemini-2.0-flash",
-    config=GenerateContentConfig(
-        system_instruction="你是一個中文的AI助手，請用繁體中文回答，並專注於搜尋Dcard相關內容。",
-        tools=[google_search_tool],
-        response_modalities=["TEXT"],
-    )
+SUMMARY_MODEL = "gemini-2.0-flash"
+chat_config = GenerateContentConfig(
+    system_instruction="你是一個中文的AI助手，請用繁體中文回答，並專注於搜尋Dcard相關內容。",
+    tools=[google_search_tool],
+    response_modalities=["TEXT"],
 )
 
 # 初始化 Flask 與 LINE
@@ -51,8 +51,80 @@ handler = WebhookHandler(channel_secret)
 
 def query(payload: str) -> str:
     """送出 prompt 給 Gemini 並回傳回應文字"""
-    response = chat.send_message(message=payload)
-    return response.text
+    # 統整結果依系所與文章快取，不能受先前的對話影響，所以每次都是不帶歷史的單次問答
+    return client.models.generate_content(model=SUMMARY_MODEL, contents=payload, config=chat_config).text
+
+# 網頁版的統整 prompt；{articles_text} 換成搜尋結果
+WEB_SUMMARY_PROMPT = (
+    "請依照以下格式統整出最多三位被學生讚美的老師與推薦原因，並美化語句寫成小段落，格式如下（不要加任何粗體或星號）：\n"
+    "老師姓名\n"
+    "推薦原因：（若原文沒有推薦原因，請參考留言或說明查無明確推薦原因）\n"
+    "介紹:（請用一小段話介紹這位老師與學生對他的看法）\n"
+    "每個欄位後請加一個換行，每位老師之間請加兩個換行，不要用空格分隔。\n"
+    "請每位老師之間用一個空行分隔，且不要出現未具名的老師。\n"
+    "注意：「資科」是資料科學，不是資管，請勿混淆。\n"
+    "最後請分成兩個區塊，第一區塊是AI統整，第二區塊是連結導向，格式如下：\n"
+    "===AI統整===\n(老師/推薦原因/介紹)\n===連結導向===\n"
+    "🔗 [文章標題1](連結1)\n🔗 [文章標題2](連結2)\n🔗 [文章標題3](連結3)\n"
+    "\n以下是搜尋結果：\n{articles_text}"
+)
+# LINE 版的摘要 prompt
+LINE_SUMMARY_PROMPT = "以下是 Dcard 上關於「{keyword}」的搜尋結果，請幫我用繁體中文統整重點並摘要：\n\n{articles_text}"
+
+# Gemini 的統整結果快取：同一個系所、同一組文章就不必再問一次
+summary_cache = ResultCache(
+    CACHE_PATH,
+    namespace="gemini_summary",
+    ttl=float(os.getenv("SUMMARY_CACHE_TTL", str(7 * 24 * 3600))),
+    stale_ttl=0,
+    negative_ttl=0,
+    max_entries=int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "256")),
+    is_negative=lambda value: not (value.get("ai_summary_block") if isinstance(value, dict) else value),
+)
+
+def format_articles(results):
+    articles_text = ""
+    for idx, item in enumerate(results, 1):
+        articles_text += f"{idx}. {item['title']}\n{item['url']}\n{item['description']}\n\n"
+    return articles_text
+
+def summary_cache_key(template, department, results):
+    """
+    以 prompt 範本（含模型名稱）、正規化後的系所與文章網址算出快取 key；
+    範本一改 key 就跟著變，舊的統整不會再被用到
+    """
+    digest = hashlib.sha256()
+    for part in (SUMMARY_MODEL, template, normalize_keyword(department), *sorted(item['url'] for item in results)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def split_summary_blocks(ai_full):
+    """把 Gemini 的回覆分成 AI 統整與連結導向兩個 HTML 區塊"""
+    if "===連結導向===" in ai_full:
+        parts = ai_full.split("===連結導向===")
+        ai_summary_block = markdown.markdown(parts[0].replace("===AI統整===","").strip())
+        ai_links_block = markdown.markdown(parts[1].strip())
+        # 讓所有連結新分頁開啟
+        ai_links_block = re.sub(r'<a ', '<a target="_blank" ', ai_links_block)
+        # 讓每個連結換行
+        ai_links_block = re.sub(r'(</a>)', r'\1<br>', ai_links_block)
+    else:
+        ai_summary_block = markdown.markdown(ai_full)
+        ai_links_block = ""
+    return ai_summary_block, ai_links_block
+
+def web_summary(department, results):
+    def generate():
+        prompt = WEB_SUMMARY_PROMPT.format(articles_text=format_articles(results))
+        ai_summary_block, ai_links_block = split_summary_blocks(query(prompt).strip())
+        return {"ai_summary_block": ai_summary_block, "ai_links_block": ai_links_block}
+    return summary_cache.get_or_fetch(summary_cache_key(WEB_SUMMARY_PROMPT, department, results), generate)
+
+def line_summary(keyword, results):
+    def generate():
+        return query(LINE_SUMMARY_PROMPT.format(keyword=keyword, articles_text=format_articles(results))).strip()
+    return summary_cache.get_or_fetch(summary_cache_key(LINE_SUMMARY_PROMPT, keyword, results), generate)
 
 # 網頁首頁：表單 + 結果
 @app.route("/", methods=['GET'])
@@ -73,37 +145,9 @@ def web_search():
             app.logger.info("找到文章數: %d", len(results))
             app.logger.info("results sample: %s", results[0] if results else "None")
             if results:
-                articles_text = ""
-                for idx, item in enumerate(results, 1):
-                    articles_text += f"{idx}. {item['title']}\n{item['url']}\n{item['description']}\n\n"
-                prompt = (
-                    "請依照以下格式統整出最多三位被學生讚美的老師與推薦原因，並美化語句寫成小段落，格式如下（不要加任何粗體或星號）：\n"
-                    "老師姓名\n"
-                    "推薦原因：（若原文沒有推薦原因，請參考留言或說明查無明確推薦原因）\n"
-                    "介紹:（請用一小段話介紹這位老師與學生對他的看法）\n"
-                    "每個欄位後請加一個換行，每位老師之間請加兩個換行，不要用空格分隔。\n"
-                    "請每位老師之間用一個空行分隔，且不要出現未具名的老師。\n"
-                    "注意：「資科」是資料科學，不是資管，請勿混淆。\n"
-                    "最後請分成兩個區塊，第一區塊是AI統整，第二區塊是連結導向，格式如下：\n"
-                    "===AI統整===\n(老師/推薦原因/介紹)\n===連結導向===\n"
-                    "🔗 [文章標題1](連結1)\n🔗 [文章標題2](連結2)\n🔗 [文章標題3](連結3)\n"
-                    f"\n以下是搜尋結果：\n{articles_text}"
-                )
-                ai_full = query(prompt).strip()
-                # 分割兩區塊
-                ai_summary_block = ""
-                ai_links_block = ""
-                if "===連結導向===" in ai_full:
-                    parts = ai_full.split("===連結導向===")
-                    ai_summary_block = markdown.markdown(parts[0].replace("===AI統整===","").strip())
-                    ai_links_block = markdown.markdown(parts[1].strip())
-                    # 讓所有連結新分頁開啟
-                    ai_links_block = re.sub(r'<a ', '<a target="_blank" ', ai_links_block)
-                    # 讓每個連結換行
-                    ai_links_block = re.sub(r'(</a>)', r'\1<br>', ai_links_block)
-                else:
-                    ai_summary_block = markdown.markdown(ai_full)
-                    ai_links_block = ""
+                summary = web_summary(department, results)
+                ai_summary_block = summary["ai_summary_block"]
+                ai_links_block = summary["ai_links_block"]
             else:
                 ai_summary_block = ""
         except Exception as e:
@@ -114,6 +158,14 @@ def web_search():
 
     return render_template('index.html', ai_summary_block=ai_summary_block, ai_links_block=ai_links_block, error=error, department=department)
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return {
+        "search_cache": search_cache.stats(),
+        "summary_cache": summary_cache.stats(),
+        "search_fanout": search_engine.stats(),
+    }
+
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature")
@@ -139,15 +191,8 @@ def handle_text_message(event):
     if not results:
         reply = ""
     else:
-        # 將搜尋結果整理成文字
-        articles_text = ""
-        for idx, item in enumerate(results, 1):
-            articles_text += f"{idx}. {item['title']}\n{item['url']}\n{item['description']}\n\n"
-        # 丟給 Gemini AI 統整
-        prompt = (
-            f"以下是 Dcard 上關於「{user_input}」的搜尋結果，請幫我用繁體中文統整重點並摘要：\n\n{articles_text}"
-        )
-        reply = query(prompt).strip()
+        # 丟給 Gemini AI 統整（同一組文章直接用快取的摘要）
+        reply = line_summary(user_input, results)
 
     with ApiClient(configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_keyword(text):
+    # 全形半形、大小寫與多餘空白都視為同一個查詢
+    return " ".join(unicodedata.normalize("NFKC", text or "").lower().split())
+
+
+class ResultCache:
+    """
+    兩層的結果快取：行程內的 LRU，加上所有行程共用的 SQLite 檔案。
+
+    - 新鮮（ttl 內）的結果直接回傳
+    - 過期但還在 stale_ttl 內的結果先回傳舊值，背景再重新抓一次（stale-while-revalidate）
+    - 空結果（is_negative 為 True）只保留 negative_ttl，避免查不到的關鍵字每次都打外部服務
+    - 同一個 key 同時有多個 request 沒命中時只會抓一次，其他人等結果
+    - 抓取失敗時若有舊值就回傳舊值
+    """
+
+    def __init__(self, db_path, namespace, ttl=6 * 3600, stale_ttl=7 * 24 * 3600, negative_ttl=600,
+                 max_entries=256, is_negative=None, refresh_workers=2, prune_interval=3600):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.is_negative = is_negative or (lambda value: not value)
+        self.refresh_workers = refresh_workers
+        self.prune_interval = prune_interval
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._flights = {}
+        self._refreshing = set()
+        self._executor = None
+        self._pid = None
+        self._last_prune = 0.0
+        self._stats = dict.fromkeys(
+            ("memory_hits", "disk_hits", "stale_hits", "negative_hits", "misses",
+             "refreshes", "fetch_errors", "stale_on_error", "store_errors"), 0)
+        self._create_table()
+
+    def _get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_table(self):
+        try:
+            self._get_connection().execute('''
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    negative INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            ''')
+        except sqlite3.Error as e:
+            # 磁碟快取壞掉時只剩記憶體這一層，不影響查詢本身
+            logging.error(f"ERROR: Failed to open result cache at {self.db_path}: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _lookup(self, key):
+        # 回傳 (value, expires_at, negative, 來源)；沒有時回傳 None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry + ("memory",)
+        try:
+            row = self._get_connection().execute(
+                "SELECT value, expires_at, negative FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"ERROR: Failed to read result cache: {e}")
+            self._count("store_errors")
+            return None
+        if row is None:
+            return None
+        entry = (json.loads(row[0]), row[1], bool(row[2]))
+        self._remember(key, entry)
+        return entry + ("disk",)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def put(self, key, value):
+        now = time.time()
+        negative = bool(self.is_negative(value))
+        expires_at = now + (self.negative_ttl if negative else self.ttl)
+        self._remember(key, (value, expires_at, negative))
+        try:
+            conn = self._get_connection()
+            conn.execute(
+                "INSERT INTO cache_entries (namespace, key, value, stored_at, expires_at, negative) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, stored_at = excluded.stored_at, "
+                "expires_at = excluded.expires_at, negative = excluded.negative",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), now, expires_at, int(negative)))
+            if now - self._last_prune >= self.prune_interval:
+                self._last_prune = now
+                conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at < ?",
+                             (self.namespace, now - self.stale_ttl))
+        except sqlite3.Error as e:
+            logging.error(f"ERROR: Failed to write result cache: {e}")
+            self._count("store_errors")
+
+    def get_or_fetch(self, key, fetch):
+        """回傳 key 的結果，沒有可用的快取時呼叫 fetch() 取得並存起來；fetch 出錯且沒有舊值時往外丟。"""
+        now = time.time()
+        entry = self._lookup(key)
+        if entry is not None:
+            value, expires_at, negative, source = entry
+            if now < expires_at:
+                self._count("negative_hits" if negative else f"{source}_hits")
+                return value
+            if not negative and now < expires_at + self.stale_ttl:
+                self._count("stale_hits")
+                self._refresh_in_background(key, fetch)
+                return value
+
+        # 同一個 key 只讓一個執行緒去抓，其他執行緒等它抓完再讀快取
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+        if not leader:
+            flight.wait()
+            entry = self._lookup(key)
+            if entry is not None and time.time() < entry[1]:
+                self._count("negative_hits" if entry[2] else "memory_hits")
+                return entry[0]
+            # 領頭的執行緒抓取失敗，自己再試一次
+            return self._fetch_and_store(key, fetch, entry)
+
+        try:
+            return self._fetch_and_store(key, fetch, entry)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.set()
+
+    def _fetch_and_store(self, key, fetch, stale_entry):
+        self._count("misses")
+        try:
+            value = fetch()
+        except Exception as e:
+            self._count("fetch_errors")
+            if stale_entry is not None and not stale_entry[2]:
+                self._count("stale_on_error")
+                logging.warning(f"WARNING: Fetch for {self.namespace} key {key!r} failed ({e}), serving stale result.")
+                return stale_entry[0]
+            raise
+        self.put(key, value)
+        return value
+
+    def _get_executor(self):
+        # fork 之後在 worker 行程裡重新建立執行緒池
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._refreshing = set()
+                self._executor = ThreadPoolExecutor(max_workers=self.refresh_workers, thread_name_prefix=f"{self.namespace}-refresh")
+            return self._executor
+
+    def _refresh_in_background(self, key, fetch):
+        executor = self._get_executor()
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        executor.submit(self._refresh, key, fetch)
+
+    def _refresh(self, key, fetch):
+        try:
+            value = fetch()
+            self._count("refreshes")
+            # 背景更新失敗或查無結果時保留原本的舊值，等下一次過期再試
+            if not self.is_negative(value):
+                self.put(key, value)
+        except Exception as e:
+            self._count("fetch_errors")
+            logging.warning(f"WARNING: Background refresh for {self.namespace} key {key!r} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_size"] = len(self._memory)
+            stats["max_entries"] = self.max_entries
+            stats["ttl_seconds"] = self.ttl
+        hits = stats["memory_hits"] + stats["disk_hits"] + stats["stale_hits"] + stats["negative_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
@@ -1,55 +1,112 @@
-import requests
+import os
 from bs4 import BeautifulSoup
 import urllib.parse
-import time
 from typing import List
 
-def ai_summary_with_dcard_links(department: str, max_retries: int = 3, verbose: bool = False) -> str:
+from result_cache import ResultCache, normalize_keyword
+from search_fanout import FanOutSearch
+
+# 搜尋結果快取：同一個系所的 Dcard 文章幾小時內不會變，不必每次都打 DuckDuckGo
+CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "/tmp/teacher_recommend_cache.db")
+search_cache = ResultCache(
+    CACHE_PATH,
+    namespace="dcard_search",
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600))),
+    stale_ttl=float(os.getenv("SEARCH_CACHE_STALE_TTL", str(7 * 24 * 3600))),
+    negative_ttl=float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL", "600")),
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "256")),
+)
+
+# 系所的簡稱與全名，搜尋時各種寫法一起查
+DEPARTMENT_ALIASES = [
+    ("中文系", "中國文學系"),
+    ("歷史系", "歷史學系"),
+    ("哲學系",),
+    ("政治系", "政治學系"),
+    ("社會系", "社會學系"),
+    ("社工系", "社會工作學系"),
+    ("音樂系", "音樂學系"),
+    ("英文系", "英國語文學系"),
+    ("日文系", "日本語文學系"),
+    ("德文系", "德國文化學系"),
+    ("數學系",),
+    ("物理系", "物理學系"),
+    ("化學系",),
+    ("微生物系", "微生物學系"),
+    ("心理系", "心理學系"),
+    ("法律系", "法律學系"),
+    ("經濟系", "經濟學系"),
+    ("會計系", "會計學系"),
+    ("企管系", "企業管理學系"),
+    ("國貿系", "國際經營與貿易學系"),
+    ("財精系", "財務工程與精算數學系"),
+    ("資管系", "資訊管理學系"),
+    ("資科系", "資料科學系"),
+]
+_ALIAS_GROUPS = {}
+for _group in DEPARTMENT_ALIASES:
+    for _name in _group:
+        _ALIAS_GROUPS[_name] = _group
+        _ALIAS_GROUPS[_name.rstrip("系")] = _group
+TEACHER_WORDS = ("推薦教授", "推薦老師")
+
+def build_queries(keyword, max_queries=4):
     """
-    AI 統整說明 + 三個 Dcard 文章連結（明確連到 dcard.tw）
+    同一個系所的幾種查詢寫法：使用者輸入的寫法排第一，再加上其他別名與「推薦老師」的說法
     """
-    query = f"東吳 {department} 推薦教授 site:dcard.tw"
-    query_enc = urllib.parse.quote(query)
-    url = f"https://html.duckduckgo.com/html/?q={query_enc}"
-
-    headers = {
-        "User-Agent": "Mozilla/5.0"
-    }
+    keyword = keyword.strip()
+    names = [keyword]
+    for alias in _ALIAS_GROUPS.get(normalize_keyword(keyword), ()):
+        if alias not in names and alias.rstrip("系") != keyword:
+            names.append(alias)
+    queries = [f"東吳 {name} {word} site:dcard.tw" for word in TEACHER_WORDS for name in names]
+    return queries[:max_queries]
 
+def parse_results(html):
+    """
+    把 DuckDuckGo 的 HTML 結果頁轉成 Dcard 文章 list，每個 dict 有 title/url/description
+    """
     results = []
-    for attempt in range(max_retries):
-        try:
-            res = requests.get(url, headers=headers, timeout=10)
-            res.raise_for_status()
-            soup = BeautifulSoup(res.text, "html.parser")
+    soup = BeautifulSoup(html, "html.parser")
+    for result in soup.select('.result'):
+        title_tag = result.select_one('.result__a')
+        desc_tag = result.select_one('.result__snippet')
+        link = title_tag['href'] if title_tag and 'href' in title_tag.attrs else ""
+        # 處理 duckduckgo 跳轉連結
+        if link.startswith("//duckduckgo.com/l/?uddg="):
+            link = urllib.parse.unquote(link.split("uddg=")[1].split("&")[0])
+        host = urllib.parse.urlsplit(link).hostname or ""
+        if (host == "dcard.tw" or host.endswith(".dcard.tw")) and title_tag and title_tag.text.strip():
+            results.append({
+                "title": title_tag.text.strip(),
+                "url": link,
+                "description": desc_tag.text.strip() if desc_tag else "無摘要"
+            })
+    return results
 
-            for result in soup.select('.result'):
-                if verbose:
-                    print("==== result html ====")
-                    print(result.prettify())
-                title_tag = result.select_one('.result__a')
-                desc_tag = result.select_one('.result__snippet')
-                link = title_tag['href'] if title_tag and 'href' in title_tag.attrs else ""
-                # 處理 duckduckgo 跳轉連結
-                if link.startswith("//duckduckgo.com/l/?uddg="):
-                    link = urllib.parse.unquote(link.split("uddg=")[1].split("&")[0])
-                if link and "dcard.tw" in link and title_tag and title_tag.text.strip():
-                    results.append({
-                        "title": title_tag.text.strip(),
-                        "url": link,
-                        "description": desc_tag.text.strip() if desc_tag else "無摘要"
-                    })
-                if len(results) >= 3:
-                    break
-            if results:
-                break
-            if verbose:
-                print("未抓到結果，DuckDuckGo 回傳內容如下：")
-                print(res.text[:2000])
-        except Exception as e:
-            if verbose:
-                print(f"搜尋失敗，第{attempt+1}次，錯誤訊息：{e}")
-            time.sleep(1)
+# 多種寫法同時搜尋：慢的 request 會補送一次，整次搜尋有時間上限，湊滿三篇就回傳
+search_engine = FanOutSearch(
+    os.getenv("DUCKDUCKGO_URL", "https://html.duckduckgo.com/html/"),
+    parse_results,
+    want=3,
+    deadline=float(os.getenv("SEARCH_DEADLINE", "8")),
+    hedge_after=float(os.getenv("SEARCH_HEDGE_AFTER", "2")),
+    headers={"User-Agent": "Mozilla/5.0"},
+)
+
+def ai_summary_with_dcard_links(department: str, verbose: bool = False) -> str:
+    """
+    AI 統整說明 + 三個 Dcard 文章連結（明確連到 dcard.tw）
+    """
+    try:
+        results = fetch_dcard_results(department)
+    except Exception as e:
+        if verbose:
+            print(f"搜尋失敗，錯誤訊息：{e}")
+        results = []
+    if verbose:
+        print(f"搜尋結果：{results}")
+        print(f"搜尋統計：{search_engine.stats()}")
 
     # AI 統整說明
     if results:
@@ -60,44 +117,26 @@ def ai_summary_with_dcard_links(department: str, max_retries: int = 3, verbose:
     else:
         return f"目前找不到東吳大學{department}推薦教授的 Dcard 文章連結。"
 
-if __name__ == "__main__":
-    department = "中文系"
-    print(ai_summary_with_dcard_links(department, verbose=True))
-
 def google_search_dcard(keyword):
     """
     回傳 Dcard 文章搜尋結果（list of dict），每個 dict 有 title/url/description
+    結果依正規化後的關鍵字快取，查不到或搜尋失敗時回傳空 list
     """
-    query = f"東吳 {keyword} 推薦教授 site:dcard.tw"
-    query_enc = urllib.parse.quote(query)
-    url = f"https://html.duckduckgo.com/html/?q={query_enc}"
-
-    headers = {
-        "User-Agent": "Mozilla/5.0"
-    }
-
-    results = []
+    key = normalize_keyword(keyword)
+    if not key:
+        return []
     try:
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status()
-        soup = BeautifulSoup(res.text, "html.parser")
-
-        for result in soup.select('.result'):
-            title_tag = result.select_one('.result__a')
-            desc_tag = result.select_one('.result__snippet')
-            link = title_tag['href'] if title_tag and 'href' in title_tag.attrs else ""
-            # 處理 duckduckgo 跳轉連結
-            if link.startswith("//duckduckgo.com/l/?uddg="):
-                link = urllib.parse.unquote(link.split("uddg=")[1].split("&")[0])
-            if link and "dcard.tw" in link and title_tag and title_tag.text.strip():
-                results.append({
-                    "title": title_tag.text.strip(),
-                    "url": link,
-                    "description": desc_tag.text.strip() if desc_tag else "無摘要"
-                })
-            if len(results) >= 3:
-                break
+        return search_cache.get_or_fetch(key, lambda: fetch_dcard_results(keyword))
     except Exception as e:
         print(f"搜尋失敗，錯誤訊息：{e}")
+        return []
 
-    return results
\ No newline at end of file
+def fetch_dcard_results(keyword):
+    """
+    實際向 DuckDuckGo 搜尋（不經過快取），所有寫法都失敗或逾時時丟出例外
+    """
+    return search_engine.search(build_queries(keyword))
+
+if __name__ == "__main__":
+    department = "中文系"
+    print(ai_summary_with_dcard_links(department, verbose=True))
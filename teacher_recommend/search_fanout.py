@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def dedupe_key(url):
+    # 同一篇文章的網址常帶不同的 query string 或 www.，只比主機與路徑
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host + parts.path.rstrip("/")
+
+
+class FanOutSearch:
+    """
+    同時送出多種查詢寫法的搜尋引擎。
+
+    - 每種寫法各送一個 request；超過 hedge_after 秒還沒回應（或很快就失敗）時再補送一個同樣的
+      request（hedging），先回來的算數，每種寫法最多 max_attempts 次
+    - 所有結果依網址去重後合併，湊到 want 筆就馬上回傳，不等其他 request
+    - 整次搜尋不超過 deadline 秒；超過時回傳已經拿到的結果
+    - 完全沒有結果時：所有 request 都正常回應就回傳空 list，否則丟出例外，讓呼叫端（快取）知道這次不算數
+    url 是搜尋頁網址（查詢字串放在 q 參數），parse(html) 把頁面轉成 [{"title", "url", "description"}, ...]。
+    """
+
+    def __init__(self, url, parse, want=3, deadline=8.0, hedge_after=2.0, max_attempts=2,
+                 max_workers=8, headers=None):
+        self.url = url
+        self.parse = parse
+        self.want = want
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.max_attempts = max_attempts
+        self.max_workers = max_workers
+        self.headers = headers or {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._session = None
+        self._stats = dict.fromkeys(
+            ("searches", "requests", "hedges", "request_errors", "early_returns", "deadline_hits"), 0)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _resources(self):
+        # fork 之後在 worker 行程裡重新建立執行緒池與連線池
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="search-fanout")
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(self.headers)
+                self._session = session
+            return self._executor, self._session
+
+    def _fetch(self, session, query, timeout):
+        response = session.get(self.url, params={"q": query}, timeout=timeout)
+        response.raise_for_status()
+        return self.parse(response.text)
+
+    def search(self, queries, want=None, deadline=None):
+        """依序送出 queries 裡的每種寫法，回傳合併去重後最多 want 筆結果。"""
+        want = want or self.want
+        started = time.monotonic()
+        stop_at = started + (deadline or self.deadline)
+        executor, session = self._resources()
+        self._count("searches")
+
+        pending = {}  # future -> 查詢寫法
+        attempts = {query: 0 for query in queries}
+        launched_at = {}
+        merged = {}
+        errors = []
+        finished = set()
+
+        def launch(query):
+            attempts[query] += 1
+            launched_at[query] = time.monotonic()
+            timeout = max(0.1, stop_at - time.monotonic())
+            pending[executor.submit(self._fetch, session, query, timeout)] = query
+            self._count("requests")
+
+        for query in attempts:
+            launch(query)
+
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= stop_at:
+                    self._count("deadline_hits")
+                    logging.warning(f"WARNING: Search fan-out hit its deadline with {len(merged)} results.")
+                    break
+                # 下一次要檢查的時間：最早該補送 hedge 的時間，或是 deadline
+                wake_at = stop_at
+                for query in set(pending.values()):
+                    if attempts[query] < self.max_attempts:
+                        wake_at = min(wake_at, launched_at[query] + self.hedge_after)
+                done, _ = wait(list(pending), timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    query = pending.pop(future, None)
+                    if query is None:
+                        continue
+                    try:
+                        hits = future.result()
+                    except Exception as e:
+                        self._count("request_errors")
+                        errors.append(e)
+                        # 失敗的寫法如果沒有其他 request 在跑，馬上再試一次
+                        if attempts[query] < self.max_attempts and query not in pending.values():
+                            self._count("hedges")
+                            launch(query)
+                        continue
+                    finished.add(query)
+                    # 同一種寫法的另一個 request（hedge）已經用不到了
+                    for other, other_query in list(pending.items()):
+                        if other_query == query:
+                            other.cancel()
+                            del pending[other]
+                    for hit in hits:
+                        merged.setdefault(dedupe_key(hit["url"]), hit)
+                    if len(merged) >= want:
+                        self._count("early_returns")
+                        return list(merged.values())[:want]
+
+                # 還沒回應太久的寫法補送一個 hedge request
+                now = time.monotonic()
+                for query in set(pending.values()):
+                    if attempts[query] < self.max_attempts and now - launched_at[query] >= self.hedge_after:
+                        self._count("hedges")
+                        launch(query)
+        finally:
+            # 還沒開始的 request 直接取消；已經在跑的會在各自的 timeout 內結束
+            for future in pending:
+                future.cancel()
+
+        if merged:
+            return list(merged.values())[:want]
+        unanswered = len(attempts) - len(finished)
+        if unanswered:
+            raise TimeoutError(
+                f"Search fan-out got no results in {time.monotonic() - started:.1f}s; "
+                f"{unanswered} of {len(attempts)} queries unanswered"
+                + (f", last error: {errors[-1]}" if errors else ""))
+        return []
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["deadline_seconds"] = self.deadline
+        stats["hedge_after_seconds"] = self.hedge_after
+        return stats